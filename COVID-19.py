@@ -1,229 +1,158 @@
 from bokeh.io import curdoc, output_file, show
 from bokeh.plotting import figure
-from bokeh.models import ColumnDataSource, GeoJSONDataSource, LinearColorMapper, LogColorMapper, ColorBar
-from bokeh.models import Div, HoverTool, RadioButtonGroup, Button, DateSlider, Span, Toggle
-from bokeh.models import DatetimeTickFormatter, PrintfTickFormatter, NumeralTickFormatter, BasicTicker, LogTicker, CustomJSHover
-from bokeh.models import DataTable, TableColumn
+from bokeh.models import ColumnDataSource, LinearColorMapper, LogColorMapper, ColorBar
+from bokeh.models import Div, HoverTool, RadioButtonGroup, Button, DateSlider, Select, Span, Spinner, Toggle
+from bokeh.models import DatetimeTickFormatter, PrintfTickFormatter, NumeralTickFormatter, BasicTickFormatter, BasicTicker, LogTicker, CustomJSHover
+from bokeh.models import DataTable, TableColumn, CustomJS
 from bokeh.palettes import brewer, Category20_16
 from bokeh.layouts import row, column
-from datetime import timedelta, date, datetime
-import geopandas as gpd
-import json
+from covid_metrics import timed, watch
+from covid_data import avg_days, cube_index, cube_var, geo_tolerance, get_data, get_future, get_rates, get_snapshot, get_states
+from covid_data import is_rate, is_signed, plot_stat, plot_var, rate_days, rate_stat
+from datetime import timedelta, date
+from functools import partial
 import numpy as np
 import pandas as pd
+import time
 
 callback_id = None
 
-##################################################
-# Function to get the WHO data from disk
-##################################################
-
-def get_who(resolution):
-    df = pd.read_csv('WHO-COVID-19-global-data.csv', encoding='utf-8', error_bad_lines=False)
-
-    df.drop(df.columns[[1,3]], axis=1, inplace=True)
-    df.rename(columns = {df.columns[0]:'Date', df.columns[1]:'Country', df.columns[2]:'Cases_New_Abs', df.columns[3]:'Cases_Tot_Abs', df.columns[4]:'Deaths_New_Abs', df.columns[5]:'Deaths_Tot_Abs'}, inplace=True)
-    df['Date'] = pd.to_datetime(df['Date'])
-    df['ToolTipDate'] = df.Date.map(lambda x: x.strftime("%b %d"))
-
-    df['Country'] = df['Country'].str.replace('\s*\(.*\)','')
-
-    df['Country'] = df['Country'].str.replace('Bahamas','The Bahamas')
-    df['Country'] = df['Country'].str.replace('Bonaire, Sint Eustatius and Saba','Caribbean Netherlands')
-    df['Country'] = df['Country'].str.replace('Brunei Darussalam','Brunei')
-    df['Country'] = df['Country'].str.replace('^Congo','Republic of the Congo')
-    df['Country'] = df['Country'].str.replace('.*Ivoire','Ivory Coast')
-    df['Country'] = df['Country'].str.replace('Curacao','Curaçao')
-    df['Country'] = df['Country'].str.replace('Eswatini', 'eSwatini')
-    df['Country'] = df['Country'].str.replace('Holy See','Vatican')
-    df['Country'] = df['Country'].str.replace('International conveyance','Diamond Princess')
-    df['Country'] = df['Country'].str.replace('^Kosovo.*','Kosovo')
-    df['Country'] = df['Country'].str.replace('^Lao.*', 'Laos')
-    df['Country'] = df['Country'].str.replace('^occupied.*','Palestine')
-    df['Country'] = df['Country'].str.replace('Republic of Korea', 'South Korea')
-    df['Country'] = df['Country'].str.replace('Republic of Moldova', 'Moldova')
-    df['Country'] = df['Country'].str.replace('Russian Federation', 'Russia')
-    df['Country'] = df['Country'].str.replace('Saint Barthélemy','Saint Barthelemy')
-    df['Country'] = df['Country'].str.replace('Sao Tome and Principe','São Tomé and Príncipe')
-    df['Country'] = df['Country'].str.replace('Serbia','Republic of Serbia')
-    df['Country'] = df['Country'].str.replace('Syrian Arab Republic','Syria')
-    df['Country'] = df['Country'].str.replace('The United Kingdom','United Kingdom')
-    df['Country'] = df['Country'].str.replace('Timor-Leste','East Timor')
-    df['Country'] = df['Country'].str.replace('Viet Nam','Vietnam')
-
-    for i, index_this in enumerate(df_sub.index[np.where((df_sub[resolution] == 'No') & (df_sub['Subunit'] != df_sub['Country']), True, False)].tolist()):
-        df['Country'] = df['Country'].str.replace(df_sub.iloc[index_this,0],df_sub.iloc[index_this,1])
-    
-    df = df.groupby(['Date','Country']).sum()
-    df = df.sort_values(['Country', 'Date'])
-    df.reset_index(inplace = True)
-    df['Cases_Avg_Abs'] = df.groupby('Country', group_keys=False).rolling('7D', on='Date').mean()['Cases_New_Abs']
-    df['Deaths_Avg_Abs'] = df.groupby('Country', group_keys=False).rolling('7D', on='Date').mean()['Deaths_New_Abs']
+# Playback target in frames (days) per second, and number of frames taken from the cube ahead of the playhead
+play_fps = 10
+play_ahead = 10
+play = {}
 
-    return df
-
-##################################################
-# Function to get the JHU data from the web
-##################################################
-
-def pull_jhu(location, resolution):
-    df = pd.read_csv(location, encoding='utf-8', error_bad_lines=False)
-    
-    df['Province/State'] = df['Province/State'].str.replace('Bonaire, Sint Eustatius and Saba','Caribbean Netherlands')
-    df['Province/State'] = df['Province/State'].str.replace('Curacao','Curaçao')
-    df['Province/State'] = df['Province/State'].str.replace('St Martin','Saint Martin')
-    df['Province/State'] = df['Province/State'].str.replace('\s*\(.*\)','')
-    
-    for i, index_this in enumerate(df.index[df['Province/State'].notnull()].tolist()):
-        country = df.iloc[index_this,1]
-        if country != 'Australia' and country != 'Canada' and country != 'China':# and df.iloc[index_this,0] in draw_sub_unit:
-            df.iloc[index_this,1] = df.iloc[index_this,0]
-            
-    df.drop(df.columns[[0,2,3]], axis=1, inplace=True)
-    df.rename(columns = {df.columns[0]:'Country'}, inplace=True)
-    
-    df['Country'] = df['Country'].str.replace('Burma','Myanmar')
-    df['Country'] = df['Country'].str.replace('Bahamas','The Bahamas')
-    df['Country'] = df['Country'].str.replace('Congo \(Brazzaville\)','Republic of the Congo')
-    df['Country'] = df['Country'].str.replace('Congo \(Kinshasa\)','Democratic Republic of the Congo')
-    df['Country'] = df['Country'].str.replace('.*Ivoire','Ivory Coast')
-    df['Country'] = df['Country'].str.replace('Eswatini', 'eSwatini')
-    df['Country'] = df['Country'].str.replace('Holy See','Vatican')
-    df['Country'] = df['Country'].str.replace('Korea, South', 'South Korea')
-    df['Country'] = df['Country'].str.replace('Reunion','Réunion')
-    df['Country'] = df['Country'].str.replace('Sao Tome and Principe','São Tomé and Príncipe')
-    df['Country'] = df['Country'].str.replace('Serbia','Republic of Serbia')
-    df['Country'] = df['Country'].str.replace('Taiwan\*','Taiwan')
-    df['Country'] = df['Country'].str.replace('Tanzania','United Republic of Tanzania')
-    df['Country'] = df['Country'].str.replace('Timor-Leste','East Timor')
-    df['Country'] = df['Country'].str.replace('US','United States of America')
-    df['Country'] = df['Country'].str.replace('West Bank and Gaza','Palestine')
-
-    for i, index_this in enumerate(df_sub.index[np.where((df_sub[resolution] == 'No') & (df_sub['Subunit'] != df_sub['Country']), True, False)].tolist()):
-        df['Country'] = df['Country'].str.replace(df_sub.iloc[index_this,0],df_sub.iloc[index_this,1])
-    
-    df = df.groupby('Country').sum()
-    
-    df.columns = pd.to_datetime(df.columns).tolist()
-    df.reset_index(inplace = True)
+# Outline detail level shown, the coarsest one fits the whole map
+detail = len(geo_tolerance) - 1
+map_range = None
 
-    return df
+# States of the country drilled into, shared like data, and their map values
+states = None
+df_states = None
 
-def get_jhu(resolution):
-    df_cases_tot = pull_jhu('https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_global.csv', resolution)
-    df_deaths_tot = pull_jhu('https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_deaths_global.csv', resolution)
-
-    first_dt = datetime.strptime('2020-01-22',"%Y-%m-%d")
-    last_dt = df_cases_tot.columns[-1]
-    prev_dt = (last_dt - timedelta(1))
-    show_dt = last_dt
-
-    # Make a copy within which the day to day changes are calculated
-    # Probably a better way to do this, but this works for now
-    df_cases_new = df_cases_tot.copy()
-    df_deaths_new = df_deaths_tot.copy()
-    new_dt = last_dt
-    while new_dt > first_dt:
-        df_cases_new[new_dt] = (df_cases_new[new_dt] - df_cases_new[(new_dt - timedelta(1))])
-        df_deaths_new[new_dt] = (df_deaths_new[new_dt] - df_deaths_new[(new_dt - timedelta(1))])
-        new_dt = (new_dt - timedelta(1))
-    df_cases_new[first_dt] = 0
-    df_deaths_new[first_dt] = 0
-
-    df_cases_tot = df_cases_tot.melt(id_vars=['Country'], var_name='Date', value_name='Cases_Tot_Abs')
-    df_cases_new = df_cases_new.melt(id_vars=['Country'], var_name='Date', value_name='Cases_New_Abs')
-    df_deaths_tot = df_deaths_tot.melt(id_vars=['Country'], var_name='Date', value_name='Deaths_Tot_Abs')
-    df_deaths_new = df_deaths_new.melt(id_vars=['Country'], var_name='Date', value_name='Deaths_New_Abs')
-
-    df = df_cases_tot[['Date', 'Country', 'Cases_Tot_Abs']].copy()
-    df['Cases_New_Abs'] = df_cases_new['Cases_New_Abs']
-    df['Cases_Avg_Abs'] = df.groupby('Country', group_keys=False).rolling('7D', on='Date').mean()['Cases_New_Abs']
-    df['Deaths_Tot_Abs'] = df_deaths_tot['Deaths_Tot_Abs']
-    df['Deaths_New_Abs'] = df_deaths_new['Deaths_New_Abs']
-    df['Deaths_Avg_Abs'] = df.groupby('Country', group_keys=False).rolling('7D', on='Date').mean()['Deaths_New_Abs']
-    df['ToolTipDate'] = df.Date.map(lambda x: x.strftime("%b %d"))
-    df = df.sort_values(['Country', 'Date'])
-    df.reset_index(inplace = True)
+# Variables kept with the map polygons for the hover, the rates are only in Selected when shown
+map_var = [var for var in plot_var if not is_rate(var)]
+map_index = [cube_var.index(var) for var in map_var]
 
-    return df
+# Points of each time series sent to the plots, one per two pixels of their width (the circles
+# are wider than that), and the dates the plots are zoomed into (None when they show them all),
+# see get_plot
+plot_points = 250
+plot_window = None
+plot_rows = None
 
 ##################################################
-# Function to get shapes using geopandas
+# Functions to fill in the map
 ##################################################
 
-def get_geo(resolution):
-    geofile = 'ne_' + resolution + '_admin_0_countries.shp'
-
-    df = gpd.read_file(geofile)[['ADMIN','geometry']]
-    df.columns = ['Country','geometry']
-
-    # 2019 update of Macedonia to North Macedonia
-    df['Country'] = df['Country'].str.replace('Macedonia','North Macedonia')
-
-    # Specific for JHU
-    if rb_who_jhu.active:
-        # Channel Islands include Guernsey and Jersey
-        df['Country'] = df['Country'].str.replace('Guernsey','Channel Islands')
-        df['Country'] = df['Country'].str.replace('Jersey','Channel Islands')
-        
-        # US includes Guam, Northern Mariana Islands, Puerto Rico, and United States Virgin Islands
-        df['Country'] = df['Country'].str.replace('Guam','United States of America')
-        df['Country'] = df['Country'].str.replace('Northern Mariana Islands','United States of America')
-        df['Country'] = df['Country'].str.replace('Puerto Rico','United States of America')
-        df['Country'] = df['Country'].str.replace('United States Virgin Islands','United States of America')
-
-    # Remove Antarctica
-    df.drop(df[df['Country'] == 'Antarctica'].index, inplace = True)
-
-    df_countries = pd.read_csv('Countries.csv', encoding='utf-8')[['Country', 'Population']]
-    df = df.merge(df_countries, left_on = 'Country', right_on = 'Country', how = 'left')
-
-    # Fix multipolygon rendering (though now selecting a polygon does not select the other parts)
-    df = df.explode()
-    df.reset_index(inplace = True)
+def get_frame(df_geo):
+    # Map values of this session, one row per polygon, filled in place by fill_map
+    df = df_geo[['Country', 'Population']].copy()
+    df['Population'] = df['Population'].fillna(0)
+    for var in map_var + ['Selected']:
+        df[var] = 0.0
 
     return df
 
 def get_map(date):
-    # Build results map
-    df = df_geo.copy()
-    df = df.merge(df_src[df_src['Date'] == date][['Country', 'Cases_Tot_Abs', 'Cases_New_Abs', 'Cases_Avg_Abs', 'Deaths_Tot_Abs', 'Deaths_New_Abs', 'Deaths_Avg_Abs']],
-                  left_on = 'Country', right_on = 'Country', how = 'left')
-    df['Cases_Tot_Rel'] = 100000*df['Cases_Tot_Abs']/df['Population']
-    df['Cases_New_Rel'] = 100000*df['Cases_New_Abs']/df['Population']
-    df['Cases_Avg_Rel'] = 100000*df['Cases_Avg_Abs']/df['Population']
-    df['Deaths_Tot_Rel'] = 100000*df['Deaths_Tot_Abs']/df['Population']
-    df['Deaths_New_Rel'] = 100000*df['Deaths_New_Abs']/df['Population']
-    df['Deaths_Avg_Rel'] = 100000*df['Deaths_Avg_Abs']/df['Population']
-    df['Selected'] = df[plot_var[sel_var]]
-    df.fillna(0, inplace = True)
+    return fill_map(df_map, data, date)
+
+def fill_map(df, data, date):
+    # Fill the map with the date's slice of the cube, no merge or copy needed
+    index_dt = data['dates'].get_indexer([date])[0]
+    if index_dt < 0:
+        return set_map(df, np.zeros((len(df), len(cube_var))))
+    return set_map(df, data['cube'][index_dt][data['index']])
+
+def set_map(df, values):
+    # Map columns from the cube's values of each polygon
+    df[map_var] = values[:, map_index]
+    df['Selected'] = values[:, cube_index[sel_var]]
 
     return df
 
+def get_shapes():
+    # Polygon outlines plus all map columns, only sent again when the shapes change
+    xs, ys = data['outlines'][detail]
+    shapes = {'xs' : xs, 'ys' : ys, 'Row' : data['index'].astype(np.int32),
+              'Country' : df_map['Country'].to_numpy(), 'Population' : df_map['Population'].to_numpy()}
+    shapes.update(get_columns(df_map))
+
+    return shapes
+
+def get_columns(df):
+    # Columns that change with the date or variable, sent on their own without the shapes
+    return {var : df[var].to_numpy() for var in map_var + ['Selected']}
+
+def get_detail(start, end):
+    # Coarsest outlines whose tolerance is within a pixel of the map
+    pixel = (end - start) / 950
+    return max(level for level, tolerance in enumerate(geo_tolerance) if tolerance <= pixel)
+
+def change_zoom(attr, old, new):
+    global detail
+
+    # Only the outlines are sent again, when zooming past another detail level
+    level = get_detail(map_range.start, map_range.end)
+    if level != detail:
+        detail = level
+        xs, ys = data['outlines'][detail]
+        source_map.data.update(xs = xs, ys = ys)
+        if states is not None:
+            xs, ys = states['outlines'][detail]
+            source_states.data.update(xs = xs, ys = ys)
+
+def get_cube():
+    # Whole cube as one flat float32 column (sent as a binary array) for playing in the browser,
+    # only for the sessions that do
+    if not tog_js.active:
+        return {'cube' : []}
+    return {'cube' : data['cube'].astype(np.float32).ravel()}
+
+def get_daily():
+    # Color scale bounds of each date (date x variable, flat like the cube) for the daily scale in the browser
+    if not tog_js.active:
+        return {'min' : [], 'max' : []}
+    return {bound : data['extremes'][bound][:-1].astype(np.float32).ravel() for bound in ['min', 'max']}
+
 def get_stats():
-    sum_population = df_grp[df_grp['Date'] == show_dt]['Population'].sum()
-    sum_cases_tot_abs = df_grp[df_grp['Date'] == show_dt]['Cases_Tot_Abs'].sum()
-    sum_cases_new_abs = df_grp[df_grp['Date'] == show_dt]['Cases_New_Abs'].sum()
-    sum_cases_avg_abs = df_grp[df_grp['Date'] == show_dt]['Cases_Avg_Abs'].sum()
-    sum_cases_tot_rel = 100000*sum_cases_tot_abs/sum_population
-    sum_cases_new_rel = 100000*sum_cases_new_abs/sum_population
-    sum_cases_avg_rel = 100000*sum_cases_avg_abs/sum_population
-    sum_deaths_tot_abs = df_grp[df_grp['Date'] == show_dt]['Deaths_Tot_Abs'].sum()
-    sum_deaths_new_abs = df_grp[df_grp['Date'] == show_dt]['Deaths_New_Abs'].sum()
-    sum_deaths_avg_abs = df_grp[df_grp['Date'] == show_dt]['Deaths_Avg_Abs'].sum()
-    sum_deaths_tot_rel = 100000*sum_deaths_tot_abs/sum_population
-    sum_deaths_new_rel = 100000*sum_deaths_new_abs/sum_population
-    sum_deaths_avg_rel = 100000*sum_deaths_avg_abs/sum_population
-
-    my_stats = dict(stat=['Tot Cases', 'New Cases', 'Avg Cases', 'Tot Deaths', 'New Deaths', 'Avg Deaths'],
-                    vabs=[sum_cases_tot_abs, sum_cases_new_abs, sum_cases_avg_abs, sum_deaths_tot_abs, sum_deaths_new_abs, sum_deaths_avg_abs],
-                    vrel=[my_format(sum_cases_tot_rel), my_format(sum_cases_new_rel), my_format(sum_cases_avg_rel),
-                          my_format(sum_deaths_tot_rel), my_format(sum_deaths_new_rel), my_format(sum_deaths_avg_rel)])
+    # Totals of the countries, region or world plotted, from their rows on the date shown
+    # (the per 100k values only from those with a population)
+    df = df_grp[df_grp['Date'] == show_dt]
+    known = df[df['Population'] > 0]
+    population = known['Population'].sum()
+    names = [(measure, stat) for measure in ['Cases', 'Deaths'] for stat in ['Tot', 'New', 'Avg']]
+    sums = [df[measure + '_' + stat + '_Abs'].sum() for measure, stat in names]
+
+    my_stats = dict(stat=[stat + ' ' + measure for measure, stat in names],
+                    vabs=sums,
+                    vrel=[my_format(100000*known[measure + '_' + stat + '_Abs'].sum()/population) if population else ''
+                          for measure, stat in names])
+
+    # Rates of those totals, from their averages summed over the days before (none on days without rows)
+    days = (pd.Timestamp(show_dt).to_datetime64() - df_grp['Date'].to_numpy()) // np.timedelta64(1, 'D')
+    near = (days >= 0) & (days <= rate_days)
+    index_dt = rate_days - days[near]
+    missing = np.bincount(index_dt, minlength=rate_days + 1) == 0
+    for measure in ['Cases', 'Deaths']:
+        avg = np.bincount(index_dt, weights=df_grp[measure + '_Avg_Abs'].to_numpy(dtype=float)[near], minlength=rate_days + 1)
+        avg = np.where(missing, np.nan, avg)
+        rates = get_rates(avg[None])
+        for stat in rate_stat[:-1]:
+            my_stats['stat'].append(stat_title[stat] + ' ' + measure)
+            my_stats['vabs'].append(get_rate(stat, rates[stat][0, -1]))
+            my_stats['vrel'].append('')
+    my_stats['stat'].append(stat_title['CFR'])
+    my_stats['vabs'].append(get_rate('CFR', 100*sums[3]/sums[0] if sums[0] else np.nan))
+    my_stats['vrel'].append('')
     return my_stats
 
+def get_rate(stat, value):
+    return '' if np.isnan(value) else rate_format[stat].format(value)
+
 
 custom=CustomJSHover(code="""
-                     if (value==0) {
+                     if (value==0 || isNaN(value)) {
                          return ""
                      }
                      var modified;
@@ -259,48 +188,132 @@ def my_format(num):
 
 # Make the map
 def make_map():
+    global map_range
+    global color_bar
+    global ren_map
+    global ren_states
+    global hover_map
+
     #Create figure object.
     p = figure(title = 'Map of COVID-19 '+plot_title[sel_var]+' ('+txt_src+')', plot_height = 550 , plot_width = 950, 
                      x_range=(-180, 180), y_range=(-65, 90), toolbar_location = 'above',
                      tools = 'pan, wheel_zoom, box_zoom, reset, tap', sizing_mode="scale_width")
     p.xgrid.grid_line_color = None
     p.ygrid.grid_line_color = None
-    
-    # Choose linear or logarithmic color mapper
-    if tog_lin.active:
-        mapper = LinearColorMapper(palette = palette, low = 0, high = plot_max[sel_var])
-        ticker = BasicTicker()
-    else:
-        mapper = LogColorMapper(palette = palette, low = plot_min[sel_var], high = plot_max[sel_var])
-        ticker = LogTicker()
 
-    color_bar = ColorBar(color_mapper = mapper, label_standoff = 8, height = 20,  ticker = ticker,
+    # The map starts zoomed out
+    map_range = p.x_range
+    change_zoom('start', None, None)
+    map_range.on_change('start', change_zoom)
+    map_range.on_change('end', change_zoom)
+    
+    # Color mapper, ticker and formatter are set by show_var
+    color_bar = ColorBar(color_mapper = mapper_log, label_standoff = 8, height = 20,
                          border_line_color = None, location = (0,0), orientation = 'horizontal') 
 
-    if not rb_abs_rel.active:
-        color_bar.formatter = NumeralTickFormatter(format='0[.]0a')
-    elif not tog_lin.active:
-        color_bar.formatter = NumeralTickFormatter(format='0.[00000]')
-        
     #Add patch renderer to figure. 
     ren_map = p.patches('xs', 'ys', source = source_map, line_color = 'black', line_width = 0.25,
-                        fill_color = {'field' : 'Selected', 'transform' : mapper}, fill_alpha = 1)
+                        fill_color = {'field' : 'Selected', 'transform' : mapper_log}, fill_alpha = 1)
+
+    # States drilled into are drawn over their country
+    ren_states = p.patches('xs', 'ys', source = source_states, line_color = 'black', line_width = 0.25,
+                           fill_color = {'field' : 'Selected', 'transform' : mapper_log}, fill_alpha = 1)
 
     #Specify figure layout.
     p.add_layout(color_bar, 'below')
     
-    #Add hover tool
-    p.add_tools(HoverTool(tooltips = [('Country/region','@Country'), ('Population','@Population'), 
-                                      ('Tot Cases','@Cases_Tot_Abs @Cases_Tot_Rel{custom}'),
-                                      ('New Cases','@Cases_New_Abs @Cases_New_Rel{custom}'),
-                                      ('Avg Cases','@Cases_Avg_Abs @Cases_Avg_Rel{custom}'),
-                                      ('Tot Deaths','@Deaths_Tot_Abs @Deaths_Tot_Rel{custom}'),
-                                      ('New Deaths','@Deaths_New_Abs @Deaths_New_Rel{custom}'),
-                                      ('Avg Deaths','@Deaths_Avg_Abs @Deaths_Avg_Rel{custom}')],
-                          formatters={'@Cases_Tot_Rel' : custom, '@Cases_New_Rel' : custom, '@Cases_Avg_Rel' : custom,
-                                      '@Deaths_Tot_Rel' : custom, '@Deaths_New_Rel' : custom, '@Deaths_Avg_Rel' : custom}))
+    #Add hover tool, its tooltips are set by show_var
+    hover_map = HoverTool(formatters={'@' + var : custom for var in plot_var if var.endswith('_Rel')})
+    p.add_tools(hover_map)
     return p
 
+##################################################
+# Functions to serve the time series plots
+##################################################
+
+def get_plot():
+    # Only the columns the plots and their hover use, with each series downsampled to plot_points,
+    # and again within the dates zoomed into so that those are shown in full
+    global plot_rows
+
+    dates = df_grp['Date'].to_numpy()
+    values = df_grp['Selected'].to_numpy(dtype=float)
+    names = df_grp['Country'].to_numpy(dtype=object)
+    x = dates.astype(np.int64) / 86400e9
+
+    # df_grp holds one block of rows per series
+    starts = np.flatnonzero(np.r_[True, names[1:] != names[:-1]]) if len(names) else np.zeros(0, dtype=int)
+    series = [np.arange(start, end) for start, end in zip(starts, np.r_[starts[1:], len(names)])]
+    index = get_downsampled(series, x, values)
+    if plot_window is not None:
+        inside = (dates >= plot_window[0]) & (dates <= plot_window[1])
+        index = np.union1d(index, get_downsampled([rows[inside[rows]] for rows in series], x, values))
+
+    plot_rows = index
+    plot = {'Date' : dates[index], 'Country' : names[index], 'Color' : df_grp['Color'].to_numpy()[index],
+            'Population' : df_grp['Population'].to_numpy()[index]}
+    plot.update(get_values())
+
+    return plot
+
+def get_values():
+    # Columns of the variable shown, at the rows of df_grp sent to the plots
+    name = plot_var[sel_var][:-4]
+    return {field : df_grp[var].to_numpy()[plot_rows] for field, var in
+            [('Selected', 'Selected'), ('Abs', name + '_Abs'), ('Rel', name + '_Rel')]}
+
+def get_downsampled(series, x, y):
+    # Rows of x and y kept of each series (given by its rows), the series of the same length
+    # being downsampled together, and those without rows (none in the dates zoomed into) left out
+    lengths = np.array([len(rows) for rows in series], dtype=int)
+    kept = [np.zeros(0, dtype=int)]
+    for length in np.unique(lengths[lengths > 0]):
+        rows = np.array([rows for rows in series if len(rows) == length]).reshape(-1, length)
+        kept.append(np.take_along_axis(rows, get_lttb(x[rows], y[rows], plot_points), axis=1).ravel())
+
+    return np.sort(np.concatenate(kept))
+
+def get_lttb(x, y, points):
+    # Positions of the points kept in each row of x and y by largest triangle three buckets: the
+    # first and the last, and in each bucket between them the point making the largest triangle
+    # with the one kept before and the mean of the next bucket, which keeps the peaks and dips.
+    # All the rows are done together, one bucket at a time.
+    count, n = x.shape
+    if n <= points or points < 3:
+        return np.tile(np.arange(n), (count, 1))
+    y = np.nan_to_num(y, nan=0, posinf=0, neginf=0)
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+
+    # Positions in each bucket, padded with its last one, and the means of the next buckets
+    columns = np.minimum(edges[:-1, None] + np.arange(np.diff(edges).max()), edges[1:, None] - 1)
+    next_x = np.c_[np.add.reduceat(x, edges, axis=1)[:, 1:-1] / np.diff(edges)[1:], x[:, -1]]
+    next_y = np.c_[np.add.reduceat(y, edges, axis=1)[:, 1:-1] / np.diff(edges)[1:], y[:, -1]]
+
+    rows = np.arange(count)
+    kept = np.zeros((count, points), dtype=int)
+    kept[:, -1] = n - 1
+    for i in range(points - 2):
+        prev_x = x[rows, kept[:, i]][:, None]
+        prev_y = y[rows, kept[:, i]][:, None]
+        area = np.abs((prev_x - next_x[:, i, None])*(y[:, columns[i]] - prev_y) - (prev_x - x[:, columns[i]])*(next_y[:, i, None] - prev_y))
+        kept[:, i + 1] = columns[i][np.argmax(area, axis=1)]
+
+    return kept
+
+def change_window(x_range, attr, old, new):
+    global plot_window
+
+    # Zoomed into part of the dates, the series are sent again in full there, but only when
+    # the dates shown change (the range also changes as the plots fit it to the data)
+    if x_range.start is None or x_range.end is None or not len(df_grp):
+        return
+    start = pd.to_datetime(x_range.start, unit='ms').floor('D').to_datetime64()
+    end = pd.to_datetime(x_range.end, unit='ms').ceil('D').to_datetime64()
+    window = (start, end) if start > df_grp['Date'].min() or end < df_grp['Date'].max() else None
+    if window != plot_window:
+        plot_window = window
+        source_grp.data = get_plot()
+
 # Make linear plot
 def make_lin():
     #Create figure object.
@@ -322,13 +335,15 @@ def make_lin():
 
     # Add your tooltips
     p.add_tools(hover)
+    p.x_range.on_change('start', partial(change_window, p.x_range))
+    p.x_range.on_change('end', partial(change_window, p.x_range))
     return p
 
-# Make logarithmic plot
+# Make logarithmic plot, zoomed along with the linear one as they share the dates shown
 def make_log():
     #Create figure object.
     p = figure(title = 'Log. Plot of COVID-19 '+plot_title[sel_var]+' ('+txt_src+')',toolbar_location = 'above',
-               plot_height = 250, plot_width = 500, x_axis_type = 'datetime', y_axis_type = 'log', 
+               plot_height = 250, plot_width = 500, x_axis_type = 'datetime', y_axis_type = 'log', x_range = p_lin.x_range,
                tools = 'pan, wheel_zoom, box_zoom, reset', sizing_mode="scale_width")
 
     # Format your x-axis as datetime.
@@ -347,6 +362,7 @@ def make_log():
     return p
     
 # Define the callback function: update_map
+@timed
 def update_map(attr, old, new):
     global show_dt
     global df_map
@@ -356,143 +372,292 @@ def update_map(attr, old, new):
         prev_dt = (pd.to_datetime(slider.value_as_date) - timedelta(1))
     else:
         prev_dt = show_dt
+    df_map = get_map(show_dt)
+    show_map()
+
+    # Moving the slider while playing carries on from there
+    if callback_id is not None:
+        play_from(show_dt)
+
+def show_map():
     dt_span.update(location=slider.value_as_date)
-    
+    show_scale()
     source_out.data = get_stats()
-    df_map = get_map(show_dt)
-    
-    #Convert to json for plotting
-    df_map_json = json.loads(df_map.to_json())
-    json_map = json.dumps(df_map_json)
-    source_map.geojson = json_map
+    source_map.data.update(get_columns(df_map))
+    if states is not None:
+        source_states.data.update(get_columns(fill_map(df_states, states, show_dt)))
 
 # Define the callback function: update_plot
+@timed
 def update_plot(attr, old, new):
     global df_grp
     try:
         selected_index = source_map.selected.indices[0]
-        old_list = source_map.selected.indices
-        old_list.sort()
-        new_list = []
-        for i,  selected_index in enumerate(source_map.selected.indices):
-            new_list = new_list + list(df_map['Country'][df_map['Country'] == df_map.iloc[selected_index]['Country']].index)
-
-        new_list = list(set(new_list))
-        new_list.sort()
-        if new_list != old_list:
+
+        # Select all the polygons of the clicked countries, sorted by index as the data source keeps them
+        countries, new_list = get_polygons(data, source_map.selected.indices)
+        if new_list != sorted(source_map.selected.indices):
             source_map.selected.update(indices = new_list)
             return
-        
-        df_grp = pd.DataFrame(columns=['Date', 'ToolTipDate', 'Country', 'Population', 'Selected', 'Color',
-                                       'Cases_Tot_Abs', 'Cases_New_Abs', 'Cases_Avg_Abs',
-                                       'Cases_Tot_Rel', 'Cases_New_Rel', 'Cases_Avg_Rel',
-                                       'Deaths_Tot_Abs', 'Deaths_New_Abs', 'Deaths_Avg_Abs',
-                                       'Deaths_Tot_Rel', 'Deaths_New_Rel', 'Deaths_Avg_Rel'])
-
-        color_index = 0
-        prev_country = 'World'
-        for i, selected_index in enumerate(source_map.selected.indices):
-            selected_country = df_map.iloc[selected_index]['Country']
-            if selected_country != prev_country:
-                prev_country = selected_country
-                pop_country = df_map.iloc[selected_index]['Population']
-                df_sel = df_src[df_src['Country'] == selected_country].copy()
-                df_sel['Country'] = selected_country
-                df_sel['Population'] = pop_country
-                df_sel['Cases_Tot_Rel'] = 100000*df_sel['Cases_Tot_Abs']/pop_country
-                df_sel['Cases_New_Rel'] = 100000*df_sel['Cases_New_Abs']/pop_country
-                df_sel['Cases_Avg_Rel'] = 100000*df_sel['Cases_Avg_Abs']/pop_country
-                df_sel['Deaths_Tot_Rel'] = 100000*df_sel['Deaths_Tot_Abs']/pop_country
-                df_sel['Deaths_New_Rel'] = 100000*df_sel['Deaths_New_Abs']/pop_country
-                df_sel['Deaths_Avg_Rel'] = 100000*df_sel['Deaths_Avg_Abs']/pop_country
-                df_sel['Selected'] = df_sel[plot_var[sel_var]]
-                df_sel['Color'] = Category20_16[color_index]
-                color_index = color_index + 1
-                df_grp = df_grp.append(df_sel, ignore_index=True)
-                        
-        df_grp = df_grp.sort_values(['Country', 'Date'])
-        source_grp.data = df_grp
+        show_states(countries)
+
+        # Likewise for the states clicked on when drilled into them
+        names, state_list = get_polygons(states, source_states.selected.indices) if states is not None else ([], [])
+        if state_list != sorted(source_states.selected.indices):
+            source_states.selected.update(indices = state_list)
+            return
+
+        # A whole region is plotted as its totals, like a country
+        field, region = sel_region.value.split('|') if sel_region.value else (None, None)
+        if region in data['total_rows'] and new_list == sorted(data['patches'][field][region].tolist()):
+            df_grp = get_total(region)
+        elif len(names):
+            df_grp = get_series(states, names)
+        else:
+            df_grp = get_series(data, countries)
 
     except IndexError:
-        df_grp = df_all.copy()
-        df_grp['Selected'] = df_grp[plot_var[sel_var]]
-        source_grp.data = df_grp
-    
+        show_states([])
+        df_grp = get_total('World')
+
+    source_grp.data = get_plot()
     source_out.data = get_stats()
+
+def get_polygons(data, indices):
+    # Countries (or states) of the polygons, and all the polygons of those
+    patches = data['patches']
+    names = pd.unique(patches['Polygon'][sorted(indices)])
+    if not len(names):
+        return names, []
+
+    return names, sorted(np.concatenate([patches['Country'][name] for name in names]).tolist())
+
+def get_series(data, names):
+    # Each country's (or state's) time series is a slice of the data, joined once at the end
+    df_sel = []
+    for color_index, name in enumerate(names):
+        df = data['src'].iloc[data['rows'].get(name, slice(0, 0))].copy()
+        df['Selected'] = df[plot_var[sel_var]]
+        df['Color'] = Category20_16[color_index % len(Category20_16)]
+        df_sel.append(df)
+
+    df_sel.sort(key=lambda df: df['Country'].iloc[0] if len(df) else '')
+    return pd.concat(df_sel, ignore_index=True)
+
+def get_total(name):
+    # Totals of the world or a region, computed with the data
+    df = data['totals'].iloc[data['total_rows'][name]].copy()
+    df['Selected'] = df[plot_var[sel_var]]
+    df['Color'] = Category20_16[0]
+
+    return df
     
-def change_var(attr, old, new):
-    curdoc().clear()
+def show_states(countries):
+    # Drill into the states of the one JHU country selected, when on, loading them in the
+    # background the first time, otherwise back out to the countries alone
+    global states
+    global df_states
+
+    country = countries[0] if len(countries) == 1 else None
+    if not tog_states.active or txt_src != 'JHU' or country not in data['bounds']:
+        country = None
+    if country == (states['country'] if states is not None else None):
+        return
+
+    future = get_states(country, data['bounds'][country]) if country is not None else None
+    if future is not None and not future.done():
+        future.add_done_callback(partial(wait_states, curdoc()))
+        future = None
+
+    if future is None:
+        states = None
+        df_states = None
+    else:
+        states = future.result()
+        df_states = fill_map(get_frame(states['geo']), states, show_dt)
+    if source_states.selected.indices:
+        source_states.selected.update(indices = [])
+    source_states.data = get_state_shapes()
+
+def wait_states(doc, future):
+    # Called on the loading thread, like wait_src
+    doc.add_next_tick_callback(partial(loaded_states, future))
+
+def loaded_states(future):
+    # Show the states if their country is still the one selected
+    if future.exception() is None:
+        show_states(pd.unique(data['patches']['Polygon'][source_map.selected.indices]))
+
+def get_state_shapes():
+    # Outlines plus map columns of the states drilled into, none when not
+    if states is None:
+        return {field : [] for field in ['xs', 'ys', 'Country', 'Population'] + map_var + ['Selected']}
+    xs, ys = states['outlines'][detail]
+    shapes = {'xs' : xs, 'ys' : ys, 'Country' : df_states['Country'].to_numpy(), 'Population' : df_states['Population'].to_numpy()}
+    shapes.update(get_columns(df_states))
+
+    return shapes
+
+def change_states(attr, old, new):
+    update_plot(None, None, None)
+
+def get_regions():
+    # Regions of the map to select from, the value is the column and name of the region
+    options = {'World' : [('', 'World')]}
+    for field in ['Continental Region', 'Statistical Region']:
+        options[field] = [(field + '|' + name, name) for name in data['patches'][field]]
+
+    return options
+
+def change_region(attr, old, new):
+    # Select all the polygons of the region, which then updates the plots
+    if new:
+        field, name = new.split('|')
+        source_map.selected.indices = data['patches'][field][name].tolist()
+    else:
+        source_map.selected.indices = []
+
+def get_var():
+    # Index into plot_var of the variable chosen with the buttons
+    return len(plot_stat) * (2 * rb_cases_deaths.active + rb_abs_rel.active) + rb_tot_new.active
+
+def get_tooltip(var):
+    # Tooltip with the per region and per capita values of a variable, just the value of the rate shown
+    measure, stat, scale = var.split('_')
+    if is_rate(var):
+        return (stat_title[stat] + ' ' + measure, '@Selected{0.[00]}')
+    return (stat_title[stat] + ' ' + measure, '@' + measure + '_' + stat + '_Abs @' + measure + '_' + stat + '_Rel{custom}')
+
+def show_var():
+    # Titles and color scale of the chosen variable, changed on the models already in the document
+    title = plot_title[sel_var] + ' (' + txt_src + ')'
+    p_map.title.text = 'Map of COVID-19 ' + title
+    p_lin.title.text = 'Lin. Plot of COVID-19 ' + title
+    p_log.title.text = 'Log. Plot of COVID-19 ' + title
+
+    # The map shows all the counts, and the rate shown if it is one
+    hover_map.tooltips = [('Country/region','@Country'), ('Population','@Population')] + \
+                         [get_tooltip(var) for var in map_var if var.endswith('_Abs')]
+    if is_rate(plot_var[sel_var]):
+        hover_map.tooltips.append(get_tooltip(plot_var[sel_var]))
+
+    # Choose the diverging color mapper for the rates that fall as well as rise, otherwise
+    # linear or logarithmic
+    show_scale()
+    if is_signed(plot_var[sel_var]):
+        mapper = mapper_div
+        ticker = ticker_lin
+    elif tog_lin.active:
+        mapper = mapper_lin
+        ticker = ticker_lin
+    else:
+        mapper = mapper_log
+        ticker = ticker_log
 
+    if not rb_abs_rel.active:
+        formatter = formatter_abs
+    elif not tog_lin.active:
+        formatter = formatter_log
+    else:
+        formatter = formatter_lin
+
+    color_bar.update(color_mapper = mapper, ticker = ticker, formatter = formatter)
+    ren_map.glyph.fill_color = {'field' : 'Selected', 'transform' : mapper}
+    ren_states.glyph.fill_color = {'field' : 'Selected', 'transform' : mapper}
+
+def show_scale():
+    # Color scale bounds of the variable over all dates, on the date shown, or over all dates
+    # clipped to the quantiles, looked up in the extremes of the data
+    extremes = data['extremes']
+    index_dt = data['dates'].get_indexer([show_dt])[0] if rb_scale.active == 1 else -1
+    low, high = ('low', 'high') if rb_scale.active == 2 else ('min', 'max')
+    field = cube_index[sel_var]
+    if is_signed(plot_var[sel_var]):
+        mapper_div.update(low = -extremes[high][index_dt, field], high = extremes[high][index_dt, field])
+    elif tog_lin.active:
+        mapper_lin.update(low = 0, high = extremes[high][index_dt, field])
+    else:
+        mapper_log.update(low = extremes[low][index_dt, field], high = extremes[high][index_dt, field])
+
+def change_scale(attr, old, new):
+    show_scale()
+
+@timed
+def change_var(attr, old, new):
     global sel_var
     global df_map
     global df_grp
 
-    #sel_var = int(str(rb_cases_deaths.active)+str(rb_abs_rel.active)+str(rb_tot_new.active), 2)
-    sel_var = 6 * rb_cases_deaths.active + 3 * rb_abs_rel.active + rb_tot_new.active
-    df_map['Selected'] = df_map[plot_var[sel_var]]
-    
-    #Convert to json for plotting
-    df_map_json = json.loads(df_map.to_json())
-    json_map = json.dumps(df_map_json)
-    source_map.geojson = json_map
+    sel_var = get_var()
+    fill_map(df_map, data, show_dt)
+    source_map.data.update(Selected = df_map['Selected'].to_numpy())
+    if states is not None:
+        fill_map(df_states, states, show_dt)
+        source_states.data.update(Selected = df_states['Selected'].to_numpy())
     
-    #df_grp = df_all.copy()
+    # The points kept by the downsampling depend on the variable, often they are the same
     df_grp['Selected'] = df_grp[plot_var[sel_var]]
-    source_grp.data = df_grp
-    source_out.data = get_stats()
-
-    if rb_cases_deaths.active and rb_tot_new.active:
-        hover.tooltips = [('Date','@ToolTipDate'), ('Country/region','@Country'), ('Population','@Population'),
-                          ('New Deaths','@Deaths_New_Abs @Deaths_New_Rel{custom}')]
-        hover.formatters = {'@Deaths_New_Rel' : custom}
-
-    elif rb_cases_deaths.active:
-        hover.tooltips = [('Date','@ToolTipDate'), ('Country/region','@Country'), ('Population','@Population'),
-                          ('Tot Deaths','@Deaths_Tot_Abs @Deaths_Tot_Rel{custom}')]
-        hover.formatters = {'@Deaths_Tot_Rel' : custom}
-    elif rb_tot_new.active:
-        hover.tooltips = [('Date','@ToolTipDate'), ('Country/region','@Country'), ('Population','@Population'),
-                          ('New Cases','@Cases_New_Abs @Cases_New_Rel{custom}')]
-        hover.formatters = {'@Cases_New_Rel' : custom}
+    rows = plot_rows
+    plot = get_plot()
+    if np.array_equal(rows, plot_rows):
+        source_grp.data.update(get_values())
     else:
-        hover.tooltips = [('Date','@ToolTipDate'), ('Country/region','@Country'), ('Population','@Population'),
-                          ('Tot Cases','@Cases_Tot_Abs @Cases_Tot_Rel{custom}')]
-        hover.formatters = {'@Cases_Tot_Rel' : custom}
+        source_grp.data = plot
+    source_out.data = get_stats()
 
-    curdoc().add_root(row(column(make_map(), row(column(heading, row(button, tog_lin, tog_res, sizing_mode="stretch_width"), sizing_mode="stretch_width"), column(rb_who_jhu, rb_cases_deaths, rb_tot_new, rb_abs_rel, sizing_mode="stretch_width")), slider, table_out, sizing_mode="scale_width"), column(make_lin(), make_log(), sizing_mode="scale_width"), sizing_mode="stretch_both"))
+    measure, stat, scale = plot_var[sel_var].split('_')
+    hover.tooltips = [('Date','@Date{%b %d}'), ('Country/region','@Country'), ('Population','@Population'),
+                      (stat_title[stat] + ' ' + measure, '@Abs{0.[00]}' if is_rate(plot_var[sel_var]) else '@Abs @Rel{custom}')]
+    show_var()
 
+@timed
 def change_src(attr, old, new):
-    curdoc().clear()
-
     global txt_src
+    global txt_res
     global df_src
     global df_geo
     global first_dt
     global last_dt
     global show_dt
     global df_map
-    global df_all
     global df_grp
-    global source_grp
+    global data
 
     if tog_res.active:
         res = '50m'
     else:
         res = '110m'
-        
-    df_geo = get_geo(res)
 
+    if rb_who_jhu.active:
+        src = 'JHU'
+    else:
+        src = 'WHO'
+
+    # Keep showing the current data while the new one loads, then come back here
+    future = get_future(src, res)
+    if not future.done():
+        rb_who_jhu.disabled = True
+        tog_res.disabled = True
+        future.add_done_callback(partial(wait_src, curdoc()))
+        return
+
+    # A newer snapshot of the data shown keeps the session's selection, region and zoom
+    refresh = (src, res) == (txt_src, txt_res)
+    txt_src = src
+    txt_res = res
     if rb_who_jhu.active:
         heading.text='Worldwide COVID-19 Statistics - <a href="https://github.com/CSSEGISandData/COVID-19" target="_blank">JHU</a></br>Click on countries (multiple with shift)</br>Created by Phil Martel - <a href="https://github.com/ppmartel/COVID-19" target="_blank">GitHub Repo.</a>'
-        txt_src = 'JHU'
-        df_src = get_jhu(res)
     else:
         heading.text='Worldwide COVID-19 Statistics - <a href="https://covid19.who.int/" target="_blank">WHO</a></br>Click on countries (multiple with shift)</br>Created by Phil Martel - <a href="https://github.com/ppmartel/COVID-19" target="_blank">GitHub Repo.</a>'
-        txt_src = 'WHO'
-        df_src = get_who(res)
 
-    first_dt = min(df_src['Date'])
-    last_dt = max(df_src['Date'])
+    data = future.result()
+    df_src = data['src']
+    df_geo = data['geo']
+    if not refresh:
+        df_map = get_frame(df_geo)
+
+    first_dt = df_src['Date'].min()
+    last_dt = df_src['Date'].max()
     slider.start = first_dt
     slider.end = last_dt
     if show_dt > last_dt:
@@ -500,56 +665,134 @@ def change_src(attr, old, new):
         slider.value = show_dt
 
     df_map = get_map(show_dt)
-    
-    #Convert to json for plotting
-    df_map_json = json.loads(df_map.to_json())
-    json_map = json.dumps(df_map_json)
+    if callback_id is not None:
+        play_from(show_dt)
+    source_cube.data = get_cube()
+    source_daily.data = get_daily()
+    source_dates.data = {'Date' : data['dates']}
+
+    # The shapes are the same, only their columns and the series plotted are filled in again
+    if refresh:
+        source_map.data.update(get_columns(df_map))
+        update_plot(None, None, None)
+        show_scale()
+        return
+
     #old_list = source_map.selected.indices
     source_map.selected.update(indices = [])
-    source_map.geojson = json_map
+    source_map.data = get_shapes()
     #source_map.selected.indices = old_list
+    sel_region.options = get_regions()
+    sel_region.value = ''
     
-    # Sum to get world statistics
-    df_all = df_src.groupby('Date').sum()
-    df_all.reset_index(inplace = True)
-    df_all['ToolTipDate'] = df_all.Date.map(lambda x: x.strftime("%b %d"))
-    df_all['Country'] = 'World'
-    df_all['Population'] = 7776350000
-    df_all['Cases_Tot_Rel'] = df_all['Cases_Tot_Abs']/77763.50
-    df_all['Cases_New_Rel'] = df_all['Cases_New_Abs']/77763.50
-    df_all['Cases_Avg_Rel'] = df_all['Cases_Avg_Abs']/77763.50
-    df_all['Deaths_Tot_Rel'] = df_all['Deaths_Tot_Abs']/77763.50
-    df_all['Deaths_New_Rel'] = df_all['Deaths_New_Abs']/77763.50
-    df_all['Deaths_Avg_Rel'] = df_all['Deaths_Avg_Abs']/77763.50
-    df_all['Selected'] = df_all['Cases_Tot_Abs']
-    df_all['Color'] = Category20_16[0]
-    
-    df_grp = df_all.copy()
-    #df_grp['Selected'] = df_grp[plot_var[sel_var]]
-    source_grp = ColumnDataSource(df_grp)
+    df_grp = get_total('World')
+    source_grp.data = get_plot()
     source_out.data = get_stats()
-    
-    curdoc().add_root(row(column(make_map(), row(column(heading, row(button, tog_lin, tog_res, sizing_mode="stretch_width"), sizing_mode="stretch_width"), column(rb_who_jhu, rb_cases_deaths, rb_tot_new, rb_abs_rel, sizing_mode="stretch_width")), slider, table_out, sizing_mode="scale_width"), column(make_lin(), make_log(), sizing_mode="scale_width"), sizing_mode="stretch_both"))
-
+    show_var()
+
+def wait_src(doc, future):
+    # Called on the loading thread, the session is only changed from its own callbacks
+    doc.add_next_tick_callback(partial(loaded_src, future))
+
+def loaded_src(future):
+    rb_who_jhu.disabled = False
+    tog_res.disabled = False
+    if future.exception() is None:
+        change_src(None, None, None)
+        return
+
+    # Could not load it, go back to the buttons of the data still shown
+    rb_who_jhu.remove_on_change('active', change_src)
+    tog_res.remove_on_change('active', change_src)
+    rb_who_jhu.active = int(txt_src == 'JHU')
+    tog_res.active = txt_res == '50m'
+    rb_who_jhu.on_change('active', change_src)
+    tog_res.on_change('active', change_src)
+
+def check_src():
+    # Show the latest data once it has been refreshed, unless playing or loading
+    if get_snapshot(txt_src, txt_res) is not data and callback_id is None and not rb_who_jhu.disabled:
+        change_src(None, None, None)
+
+def get_frames(index_dt):
+    # Map values of the next frames, taken from the cube in one go
+    index_end = min(index_dt + play_ahead, len(data['dates']))
+    return data['cube'][index_dt:index_end][:, data['index']]
+
+def play_from(date):
+    # Restart the playback clock from a date, frames are then due at play_fps from there
+    index_dt = max(data['dates'].searchsorted(date), 0)
+    play.update(start = index_dt, shown = index_dt, time = time.perf_counter(), drawn = 0, dropped = 0,
+                first = index_dt, frames = get_frames(index_dt), cube = data['cube'])
+
+@timed
 def animate_update():
     global show_dt
-    slider.value = slider.value_as_date + timedelta(1)
-    show_dt = pd.to_datetime(slider.value_as_date)
-    if last_dt == pd.to_datetime(slider.value_as_date):
+
+    # Frame due at this time, any frames missed while the server was busy are dropped rather than queued
+    last = len(data['dates']) - 1
+    elapsed = time.perf_counter() - play['time']
+    index_dt = min(play['start'] + int(elapsed * play_fps), last)
+    if index_dt <= play['shown']:
+        return
+    play['dropped'] += index_dt - play['shown'] - 1
+    play['shown'] = index_dt
+
+    # Take the next frames from the cube once they run out (or the data changed)
+    if play['cube'] is not data['cube'] or index_dt >= play['first'] + len(play['frames']):
+        play.update(first = index_dt, frames = get_frames(index_dt), cube = data['cube'])
+
+    show_dt = data['dates'][index_dt]
+    set_map(df_map, play['frames'][index_dt - play['first']])
+    slider.value = show_dt
+    show_map()
+
+    play['drawn'] += 1
+    slider.title = 'Date ({:.1f} fps, {} dropped)'.format(play['drawn'] / max(elapsed, 1e-3), play['dropped'])
+    if index_dt == last:
         animate()
 
 def animate():
     global callback_id
+
+    # Played by js_play in the browser instead
+    if tog_js.active:
+        return
+
     if button.label == '► Play':
-        slider.on_change('value', update_map)
         if last_dt.date() == slider.value_as_date:
             slider.value = first_dt
         button.label = '❚❚ Pause'
-        callback_id = curdoc().add_periodic_callback(animate_update, 1)
+        play_from(pd.to_datetime(slider.value_as_date))
+        callback_id = curdoc().add_periodic_callback(animate_update, 1000 / play_fps)
     else:
-        slider.remove_on_change('value', update_map)
         button.label = '► Play'
         curdoc().remove_periodic_callback(callback_id)
+        callback_id = None
+
+def change_js(attr, old, new):
+    global callback_id
+
+    # Stop playing on the server before handing over to the browser, not through animate
+    # as that returns early once tog_js is on
+    if new and callback_id is not None:
+        curdoc().remove_periodic_callback(callback_id)
+        callback_id = None
+        button.label = '► Play'
+    source_cube.data = get_cube()
+    source_daily.data = get_daily()
+    source_dates.data = {'Date' : data['dates']}
+
+def change_fps(attr, old, new):
+    global play_fps
+    global callback_id
+
+    # Restart the clock, and the callback at the new period, while playing
+    play_fps = new
+    if callback_id is not None:
+        curdoc().remove_periodic_callback(callback_id)
+        play_from(pd.to_datetime(slider.value_as_date))
+        callback_id = curdoc().add_periodic_callback(animate_update, 1000 / play_fps)
 
 ##################################################
 # Main code
@@ -564,6 +807,14 @@ heading = Div(text='Worldwide COVID-19 Statistics - <a href="https://covid19.who
 button = Button(label='► Play', height = 30)
 button.on_click(animate)
 
+# Frames per second to play at
+spin_fps = Spinner(value = play_fps, low = 1, high = 30, step = 1, width = 60, height = 30)
+spin_fps.on_change('value', change_fps)
+
+# Make a toggle to play in the browser from the whole cube
+tog_js = Toggle(label = 'Local Play', active = False, height = 30)
+tog_js.on_change('active', change_js)
+
 # Make a toggle for changing the map to linear
 tog_lin = Toggle(label = 'Lin Map', active = False, height = 30)
 tog_lin.on_change('active', change_var)
@@ -571,6 +822,10 @@ tog_lin.on_change('active', change_var)
 tog_res = Toggle(label = 'Hi Res', active = False, height = 30)
 tog_res.on_change('active', change_src)
 
+# Make a toggle to drill into the states of a JHU country when it is clicked, see show_states
+tog_states = Toggle(label = 'States', active = False, height = 30)
+tog_states.on_change('active', change_states)
+
 rb_who_jhu = RadioButtonGroup(labels=['WHO', 'JHU'], active=0, height = 30)
 rb_who_jhu.on_change('active', change_src)
 
@@ -580,56 +835,54 @@ rb_cases_deaths.on_change('active', change_var)
 rb_abs_rel = RadioButtonGroup(labels=['Per Region', 'Per 100k'], active=0, height = 30)
 rb_abs_rel.on_change('active', change_var)
 
-rb_tot_new = RadioButtonGroup(labels=['Total', 'New', 'Avg'], active=0, height = 30)
+# Names of the statistics, the 7 day average is just 'Avg'
+stat_title = {'Tot' : 'Tot', 'New' : 'New'}
+stat_title.update({stat : 'Avg' if days == 7 else '{}d Avg'.format(days) for stat, days in avg_days.items()})
+stat_title.update({stat : stat for stat in rate_stat})
+
+# Titles and formats of the rates, which are the same per region and per 100k
+rate_title = {'Growth' : 'Growth of {} (%/day)', 'Doubling' : 'Doubling Time of {} (days)', 'WoW' : 'Week over Week Change of {} (%)',
+              'Rt' : 'Rt of {}', 'CFR' : 'Deaths per 100 Cases'}
+rate_format = {'Growth' : '{:+.1f}%/day', 'Doubling' : '{:.0f} days', 'WoW' : '{:+.0f}%', 'Rt' : '{:.2f}', 'CFR' : '{:.2f}%'}
+
+rb_tot_new = RadioButtonGroup(labels=['Total'] + [stat_title[stat] for stat in plot_stat[1:]], active=0, height = 30)
 rb_tot_new.on_change('active', change_var)
 
-#sel_var = int(str(rb_cases_deaths.active)+str(rb_abs_rel.active)+str(rb_tot_new.active), 2)
-sel_var = 6 * rb_cases_deaths.active + 3 * rb_abs_rel.active + rb_tot_new.active
+# Make a selection of the color scale, see show_scale
+rb_scale = RadioButtonGroup(labels=['Fixed Scale', 'Daily Scale', 'Clipped Scale'], active=0, height = 30)
+rb_scale.on_change('active', change_scale)
+
+sel_var = get_var()
 
 # Make a selection of what to plot
-plot_title = ['Tot Cases', 'New Cases', 'Avg Cases', 'Tot Cases/100k Ppl', 'New Cases/100k Ppl', 'Avg Cases/100k Ppl',
-              'Tot Deaths', 'New Deaths', 'Avg Deaths', 'Tot Deaths/100k Ppl', 'New Deaths/100k Ppl', 'Avg Deaths/100k Ppl']
-plot_var = ['Cases_Tot_Abs', 'Cases_New_Abs', 'Cases_Avg_Abs', 'Cases_Tot_Rel', 'Cases_New_Rel', 'Cases_Avg_Rel',
-            'Deaths_Tot_Abs', 'Deaths_New_Abs', 'Deaths_Avg_Abs', 'Deaths_Tot_Rel', 'Deaths_New_Rel', 'Deaths_Avg_Rel']
+plot_title = [rate_title[var.split('_')[1]].format(var.split('_')[0]) if is_rate(var) else
+              stat_title[var.split('_')[1]] + ' ' + var.split('_')[0] + ('/100k Ppl' if var.endswith('_Rel') else '') for var in plot_var]
 
 ##################################################
-# Get subunits for countries to merge
+# Get the data, shared with other sessions
 ##################################################
-df_sub = pd.read_csv('Subunits_and_small_shapes.csv', encoding='utf-8', error_bad_lines=False)
-
-df_geo = get_geo('110m')
-df_src = get_who('110m')
 txt_src = 'WHO'
+txt_res = '110m'
+data = get_data(txt_src, txt_res)
+df_src = data['src']
+df_geo = data['geo']
 
-first_dt = min(df_src['Date'])
-last_dt = max(df_src['Date'])
+first_dt = df_src['Date'].min()
+last_dt = df_src['Date'].max()
 prev_dt = (last_dt - timedelta(1))
 show_dt = last_dt
 
+df_map = get_frame(df_geo)
 df_map = get_map(show_dt)
 
-#Convert to json for plotting
-df_map_json = json.loads(df_map.to_json())
-json_map = json.dumps(df_map_json)
-source_map = GeoJSONDataSource(geojson = json_map)
-
-# Sum to get world statistics
-df_all = df_src.groupby('Date').sum()
-df_all.reset_index(inplace = True)
-df_all['ToolTipDate'] = df_all.Date.map(lambda x: x.strftime("%b %d"))
-df_all['Country'] = 'World'
-df_all['Population'] = 7776350000
-df_all['Cases_Tot_Rel'] = df_all['Cases_Tot_Abs']/77763.50
-df_all['Cases_New_Rel'] = df_all['Cases_New_Abs']/77763.50
-df_all['Cases_Avg_Rel'] = df_all['Cases_Avg_Abs']/77763.50
-df_all['Deaths_Tot_Rel'] = df_all['Deaths_Tot_Abs']/77763.50
-df_all['Deaths_New_Rel'] = df_all['Deaths_New_Abs']/77763.50
-df_all['Deaths_Avg_Rel'] = df_all['Deaths_Avg_Abs']/77763.50
-df_all['Selected'] = df_all['Cases_Tot_Abs']
-df_all['Color'] = Category20_16[0]
-
-df_grp = df_all.copy()
-source_grp = ColumnDataSource(df_grp)
+# Shapes are sent once, later updates only replace the changed columns
+source_map = ColumnDataSource(get_shapes())
+
+# States of the country drilled into, none to start with
+source_states = ColumnDataSource(get_state_shapes())
+
+df_grp = get_total('World')
+source_grp = ColumnDataSource(get_plot())
 
 #Define a sequential multi-hue color palette.
 palette = brewer['YlGnBu'][9]
@@ -638,16 +891,21 @@ palette = brewer['YlGnBu'][9]
 palette = palette[::-1]
 
 # Hover tool
-hover = HoverTool(tooltips= [('Date','@ToolTipDate'),
+hover = HoverTool(tooltips= [('Date','@Date{%b %d}'),
                              ('Country/region','@Country'), ('Population','@Population'),
-                             ('Cases','@Cases_Tot_Abs @Cases_Tot_Rel{custom}')],
-                  formatters={'@Cases_Tot_Rel' : custom}, mode = 'vline')
-
-plot_min = [1, 1, 1, 0.0005, 0.0005, 0.0005, 1, 1, 1, 0.0005, 0.00001, 0.00001]
-plot_max = [max(df_map[plot_var[0]]), max(df_map[plot_var[1]]), max(df_map[plot_var[2]]),
-            max(df_map[plot_var[3]]), max(df_map[plot_var[4]]), max(df_map[plot_var[5]]),
-            max(df_map[plot_var[6]]), max(df_map[plot_var[7]]), max(df_map[plot_var[8]]),
-            max(df_map[plot_var[9]]), max(df_map[plot_var[10]]), max(df_map[plot_var[11]])]
+                             ('Cases','@Abs @Rel{custom}')],
+                  formatters={'@Date' : 'datetime', '@Rel' : custom}, mode = 'vline')
+
+# Color scales, switched between by show_var and rescaled in place by show_scale. The rates
+# that fall as well as rise are blue when falling and red when rising, and missing rates gray
+mapper_lin = LinearColorMapper(palette = palette)
+mapper_log = LogColorMapper(palette = palette)
+mapper_div = LinearColorMapper(palette = brewer['RdBu'][11])
+ticker_lin = BasicTicker()
+ticker_log = LogTicker()
+formatter_abs = NumeralTickFormatter(format='0[.]0a')
+formatter_log = NumeralTickFormatter(format='0.[00000]')
+formatter_lin = BasicTickFormatter()
 
 # Make a selection of the date to plot
 slider = DateSlider(title = 'Date', start = first_dt, end = last_dt, step = 1, value = last_dt,
@@ -660,6 +918,108 @@ dt_span = Span(location=slider.value_as_date, dimension='height', line_color='re
 
 # Update timeseries plots based on selection
 source_map.selected.on_change('indices', update_plot)
+source_states.selected.on_change('indices', update_plot)
+
+# Cube for playing in the browser, empty unless asked for
+source_cube = ColumnDataSource(get_cube())
+source_daily = ColumnDataSource(get_daily())
+source_dates = ColumnDataSource({'Date' : data['dates']})
+
+# Fill the map columns of the slider's date from the cube, without going to the server
+js_frame = CustomJS(args=dict(source=source_map, cube=source_cube, dates=source_dates, slider=slider, span=dt_span,
+                              tog_js=tog_js, rb_cases_deaths=rb_cases_deaths, rb_abs_rel=rb_abs_rel,
+                              rb_tot_new=rb_tot_new, vars=cube_var, columns=cube_index, stats=len(plot_stat),
+                              signed=[i for i, var in enumerate(cube_var) if is_signed(var)], daily=source_daily,
+                              rb_scale=rb_scale, tog_lin=tog_lin, mapper_lin=mapper_lin, mapper_log=mapper_log,
+                              mapper_div=mapper_div), code="""
+                   if (!tog_js.active || cube.data['cube'].length == 0) {
+                       return
+                   }
+                   var values = cube.data['cube'];
+                   var days = dates.data['Date'];
+                   var rows = source.data['Row'];
+
+                   // last date on or before the slider
+                   var d = 0;
+                   while (d < days.length - 1 && days[d + 1] <= slider.value) {
+                       d++;
+                   }
+
+                   var n_var = vars.length;
+                   var n_row = values.length / (days.length * n_var);
+                   for (var v = 0; v < n_var; v++) {
+                       var col = source.data[vars[v]];
+                       if (col === undefined) {
+                           continue
+                       }
+                       for (var i = 0; i < rows.length; i++) {
+                           col[i] = values[(d * n_row + rows[i]) * n_var + v];
+                       }
+                   }
+
+                   // same as get_var, then its column of the cube
+                   var s = columns[stats * (2 * rb_cases_deaths.active + rb_abs_rel.active) + rb_tot_new.active];
+                   var selected = source.data['Selected'];
+                   for (var i = 0; i < rows.length; i++) {
+                       selected[i] = values[(d * n_row + rows[i]) * n_var + s];
+                   }
+
+                   // same as show_scale for the daily scale
+                   if (rb_scale.active == 1) {
+                       var k = d * n_var + s;
+                       if (signed.indexOf(s) >= 0) {
+                           mapper_div.low = -daily.data['max'][k];
+                           mapper_div.high = daily.data['max'][k];
+                       } else if (tog_lin.active) {
+                           mapper_lin.high = daily.data['max'][k];
+                       } else {
+                           mapper_log.low = daily.data['min'][k];
+                           mapper_log.high = daily.data['max'][k];
+                       }
+                   }
+
+                   span.location = slider.value;
+                   source.change.emit();
+                   """)
+slider.js_on_change('value', js_frame)
+
+# Step the slider in the browser, when done the server catches up through value_throttled
+js_play = CustomJS(args=dict(button=button, slider=slider, spin_fps=spin_fps, tog_js=tog_js), code="""
+                  function stop() {
+                      clearInterval(window.covid_timer);
+                      window.covid_timer = null;
+                      button.label = '► Play';
+                      slider.value_throttled = slider.value;
+                  }
+                  // switching back to the server only stops, and the server plays the button itself
+                  if (cb_obj === tog_js || !tog_js.active) {
+                      if (window.covid_timer) {
+                          stop();
+                      }
+                      return
+                  }
+                  if (window.covid_timer) {
+                      stop();
+                      return
+                  }
+                  if (slider.value >= slider.end) {
+                      slider.value = slider.start;
+                  }
+                  button.label = '❚❚ Pause';
+                  window.covid_timer = setInterval(function() {
+                      if (!tog_js.active || slider.value >= slider.end) {
+                          stop();
+                          return
+                      }
+                      slider.value = Math.min(slider.value + 86400000, slider.end);
+                  }, 1000 / spin_fps.value);
+                  """)
+button.js_on_click(js_play)
+tog_js.js_on_change('active', js_play)
+
+# Select the countries of a whole region
+sel_region = Select(options = get_regions(), value = '', height = 30)
+sel_region.on_change('value', change_region)
 
 # Make a set of labels to show some totals on the map
 source_out = ColumnDataSource(get_stats())
@@ -668,5 +1028,17 @@ columns_out = [TableColumn(field='stat', title="Statistic"),
                TableColumn(field='vrel', title="Per Capita")]
 table_out = DataTable(source=source_out, columns=columns_out, height=125, width=100, sizing_mode="stretch_width")
 
+# Sizes of the data sent to the browser, when the metrics are on
+watch(curdoc(), {'source_map' : source_map, 'source_states' : source_states, 'source_grp' : source_grp, 'source_cube' : source_cube})
+
+# Look for refreshed data every minute
+curdoc().add_periodic_callback(check_src, 60000)
+
+# Make the plots once, the buttons then only change their models
+p_map = make_map()
+p_lin = make_lin()
+p_log = make_log()
+show_var()
+
 # Make a column layout of widgets and plots
-curdoc().add_root(row(column(make_map(), row(column(heading, row(button, tog_lin, tog_res, sizing_mode="stretch_width"), sizing_mode="stretch_width"), column(rb_who_jhu, rb_cases_deaths, rb_tot_new, rb_abs_rel, sizing_mode="stretch_width")), slider, table_out, sizing_mode="scale_width"), column(make_lin(), make_log(), sizing_mode="scale_width"), sizing_mode="stretch_both"))
+curdoc().add_root(row(column(p_map, row(column(heading, row(button, spin_fps, tog_js, tog_lin, tog_res, tog_states, sizing_mode="stretch_width"), sizing_mode="stretch_width"), column(rb_who_jhu, rb_cases_deaths, rb_tot_new, rb_abs_rel, rb_scale, sel_region, sizing_mode="stretch_width")), slider, table_out, sizing_mode="scale_width"), column(p_lin, p_log, sizing_mode="scale_width"), sizing_mode="stretch_both"))
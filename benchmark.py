@@ -0,0 +1,721 @@
+from bokeh.protocol.messages.patch_doc import process_document_events
+from datetime import timedelta
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from shapely.geometry import MultiPolygon, Polygon, box
+from urllib.request import urlopen
+import argparse
+import geopandas as gpd
+import json
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Run the dashboard headless against synthetic data of a configurable size:
+#   python benchmark.py --days 300 --frames 50
+# An older revision can be compared by saving it elsewhere and passing --app:
+#   git show HEAD~1:COVID-19.py > /tmp/old.py && python benchmark.py --app /tmp/old.py
+# The suite of the main functions can be saved as a baseline, and later runs fail
+# (exit status 1) when they are slower, use more memory or send more than it:
+#   python benchmark.py --suite-only --save baseline.json
+#   python benchmark.py --suite-only --baseline baseline.json
+
+app_dir = os.path.dirname(os.path.abspath(__file__))
+
+# WHO spellings of the countries which get_who renames
+who_names = {'The Bahamas' : 'Bahamas', 'Brunei' : 'Brunei Darussalam', 'Republic of the Congo' : 'Congo',
+             'Ivory Coast' : "Côte d'Ivoire", 'Curaçao' : 'Curacao', 'eSwatini' : 'Eswatini', 'Vatican' : 'Holy See',
+             'Laos' : "Lao People's Democratic Republic", 'South Korea' : 'Republic of Korea',
+             'Moldova' : 'Republic of Moldova', 'Russia' : 'Russian Federation', 'Republic of Serbia' : 'Serbia',
+             'São Tomé and Príncipe' : 'Sao Tome and Principe', 'Syria' : 'Syrian Arab Republic',
+             'East Timor' : 'Timor-Leste', 'Vietnam' : 'Viet Nam', 'Palestine' : 'occupied Palestinian territory'}
+
+# JHU spellings of the countries which pull_jhu renames
+jhu_names = {'Myanmar' : 'Burma', 'The Bahamas' : 'Bahamas', 'Republic of the Congo' : 'Congo (Brazzaville)',
+             'Democratic Republic of the Congo' : 'Congo (Kinshasa)', 'Ivory Coast' : "Cote d'Ivoire",
+             'eSwatini' : 'Eswatini', 'Vatican' : 'Holy See', 'South Korea' : 'Korea, South',
+             'São Tomé and Príncipe' : 'Sao Tome and Principe', 'Republic of Serbia' : 'Serbia', 'Taiwan' : 'Taiwan*',
+             'United Republic of Tanzania' : 'Tanzania', 'East Timor' : 'Timor-Leste', 'United States of America' : 'US',
+             'Palestine' : 'West Bank and Gaza'}
+
+##################################################
+# Synthetic input files
+##################################################
+
+def get_countries(count=None):
+    # The countries of Countries.csv, or the first count of them, made up ones past those
+    df = pd.read_csv(os.path.join(app_dir, 'Countries.csv'), encoding='utf-8')
+    countries = df[~df['Country'].isin(['Antarctica', 'Diamond Princess'])]['Country'].tolist()
+    if count is None:
+        return countries
+    return (countries + ['Country {}'.format(i) for i in range(len(countries), count)])[:count]
+
+def make_shapes(countries, resolution, path):
+    # One jagged circle per country on a grid, every fifth one with extra islands, the grid
+    # cells shrinking from 10 x 20 degrees when there are too many countries to fit
+    rng = np.random.default_rng(2)
+    parts = 3 if resolution == '110m' else 8
+    vertices = 32 if resolution == '110m' else 256
+    angle = np.linspace(0, 2*np.pi, vertices, endpoint=False)
+    size = min(1, np.sqrt(245 / len(countries)))
+    columns = int(35 / size)
+    shapes = []
+    for i, country in enumerate(countries):
+        x0 = -175 + 10*size*(i % columns)
+        y0 = -55 + 20*size*(i // columns)
+        radius = 4*size*(1 + 0.05*rng.random(vertices))
+        polygons = [Polygon(zip(x0 + 4*size + radius*np.cos(angle), y0 + 4*size + radius*np.sin(angle)))]
+        if i % 5 == 0:
+            for j in range(1, parts):
+                polygons.append(Polygon(zip(x0 + 8.5*size + 0.4*size*np.cos(angle), y0 + j*size + 0.4*size*np.sin(angle))))
+        shapes.append(MultiPolygon(polygons) if len(polygons) > 1 else polygons[0])
+
+    df = gpd.GeoDataFrame({'ADMIN' : countries, 'geometry' : shapes}, crs='EPSG:4326')
+    df.to_file(os.path.join(path, 'ne_' + resolution + '_admin_0_countries.shp'), encoding='utf-8')
+
+def make_who(countries, days, path):
+    dates = pd.date_range('2020-01-03', periods=days)
+    rng = np.random.default_rng(0)
+    cases_new = rng.poisson(50, (len(countries), days))
+    deaths_new = rng.poisson(2, (len(countries), days))
+    df = pd.DataFrame({'Date_reported' : np.tile(dates.strftime('%Y-%m-%d'), len(countries)),
+                       'Country_code' : 'XX',
+                       'Country' : np.repeat([who_names.get(c, c) for c in countries], days),
+                       'WHO_region' : 'XXXX',
+                       'New_cases' : cases_new.ravel(),
+                       'Cumulative_cases' : cases_new.cumsum(axis=1).ravel(),
+                       'New_deaths' : deaths_new.ravel(),
+                       'Cumulative_deaths' : deaths_new.cumsum(axis=1).ravel()})
+    df.to_csv(os.path.join(path, 'WHO-COVID-19-global-data.csv'), index=False, encoding='utf-8')
+
+def make_jhu(countries, days, path):
+    # Cumulative cases and deaths, one column per date, with a few countries split into provinces
+    dates = pd.date_range('2020-01-22', periods=days)
+    rng = np.random.default_rng(1)
+    rows = []
+    for country in countries:
+        if country in ['Australia', 'Canada', 'China']:
+            rows += [(country + ' ' + str(i), country) for i in range(5)]
+        else:
+            rows.append((np.nan, jhu_names.get(country, country)))
+    for name, scale in [('confirmed', 50), ('deaths', 2)]:
+        df = pd.DataFrame(rng.poisson(scale, (len(rows), days)).cumsum(axis=1),
+                          columns=['{}/{}/{}'.format(dt.month, dt.day, dt.strftime('%y')) for dt in dates])
+        df.insert(0, 'Province/State', [province for province, country in rows])
+        df.insert(1, 'Country/Region', [country for province, country in rows])
+        df.insert(2, 'Lat', 0.0)
+        df.insert(3, 'Long', 0.0)
+        df.to_csv(os.path.join(path, 'time_series_covid19_' + name + '_global.csv'), index=False, encoding='utf-8')
+
+def make_states(days, path, counties=3000):
+    # Counties of the US in 50 states, for the JHU US files, and the states of the countries JHU
+    # has them for as strips across their shapes, with those of make_jhu outside the US
+    dates = pd.date_range('2020-01-22', periods=days)
+    rng = np.random.default_rng(3)
+    states = ['State {}'.format(i) for i in range(50)]
+    names = np.array(states)[np.arange(counties) % len(states)]
+    for name, scale in [('confirmed', 5), ('deaths', 0.2)]:
+        df = pd.DataFrame(rng.poisson(scale, (counties, days)).cumsum(axis=1),
+                          columns=['{}/{}/{}'.format(dt.month, dt.day, dt.strftime('%y')) for dt in dates])
+        columns = [('UID', np.arange(counties)), ('iso2', 'US'), ('iso3', 'USA'), ('code3', 840), ('FIPS', np.arange(counties)),
+                   ('Admin2', ['County {}'.format(i) for i in range(counties)]), ('Province_State', names),
+                   ('Country_Region', 'US'), ('Lat', 0.0), ('Long_', 0.0), ('Combined_Key', '')]
+        if name == 'deaths':
+            columns.append(('Population', rng.integers(1000, 100000, counties)))
+        for i, (column, values) in enumerate(columns):
+            df.insert(i, column, values)
+        df.to_csv(os.path.join(path, 'time_series_covid19_' + name + '_US.csv'), index=False, encoding='utf-8')
+
+    df_geo = gpd.read_file(os.path.join(path, 'ne_110m_admin_0_countries.shp'))
+    rows = []
+    for country, names in [('United States of America', states)] + [(country, [country + ' ' + str(i) for i in range(5)])
+                                                                     for country in ['Australia', 'Canada', 'China']]:
+        minx, miny, maxx, maxy = df_geo[df_geo['ADMIN'] == country].total_bounds
+        width = (maxx - minx) / len(names)
+        rows += [(country, name, box(minx + i*width, miny, minx + (i + 1)*width, maxy)) for i, name in enumerate(names)]
+    # The provinces of China only match the JHU names by their English name, like Tibet (Xizang)
+    df = gpd.GeoDataFrame({'admin' : [admin for admin, name, shape in rows], 'name' : [name.replace('China', 'Zhongguo') for admin, name, shape in rows],
+                           'name_en' : [name for admin, name, shape in rows], 'geometry' : [shape for admin, name, shape in rows]}, crs='EPSG:4326')
+    df.to_file(os.path.join(path, 'ne_10m_admin_1_states_provinces.shp'), encoding='utf-8')
+
+def make_data(days, count=None):
+    path = tempfile.mkdtemp(prefix='covid-bench-')
+    countries = get_countries(count)
+    for file in ['Aliases.csv', 'Countries.csv', 'Subunits_and_small_shapes.csv']:
+        shutil.copy(os.path.join(app_dir, file), path)
+    make_shapes(countries, '110m', path)
+    make_shapes(countries, '50m', path)
+    make_who(countries, days, path)
+    make_jhu(countries, days, path)
+    return path
+
+##################################################
+# Timing
+##################################################
+
+def load_app(path, file):
+    # Run the app script in a namespace of our own, which then holds its live globals
+    app = {'__name__' : 'covid_bench', '__file__' : file}
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        with open(file, encoding='utf-8') as f:
+            exec(compile(f.read(), file, 'exec'), app)
+    finally:
+        os.chdir(cwd)
+    return app
+
+def set_widget(app, name, value):
+    # Change a widget, waiting for any data it loads as the server would
+    app[name].active = value
+    if 'loaded_src' in app and app['rb_who_jhu'].disabled:
+        future = app['get_future']('JHU' if app['rb_who_jhu'].active else 'WHO', '50m' if app['tog_res'].active else '110m')
+        future.exception()
+        app['loaded_src'](future)
+
+class StandIn(SimpleHTTPRequestHandler):
+    # Local stand-in for the JHU files on GitHub, answering conditional requests with an ETag
+    directory = None
+
+    def translate_path(self, path):
+        return os.path.join(self.directory, os.path.basename(path))
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        self.etag = '"{:x}"'.format(int(os.path.getmtime(path)*1e6)) if os.path.exists(path) else None
+        if self.etag and self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return None
+        return super().send_head()
+
+    def end_headers(self):
+        if self.etag:
+            self.send_header('ETag', self.etag)
+        super().end_headers()
+
+    def log_message(self, *args):
+        pass
+
+def time_src(app, path):
+    # Switch the session to JHU served from the stand-in, then check it for new data
+    StandIn.directory = path
+    server = HTTPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    covid_data = sys.modules['covid_data']
+    url = 'http://127.0.0.1:{}/'.format(server.server_port)
+    covid_data.sources['JHU'] = [url + 'time_series_covid19_confirmed_global.csv', url + 'time_series_covid19_deaths_global.csv']
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        start = time.perf_counter()
+        set_widget(app, 'rb_who_jhu', 1)
+        print('Switch to JHU (download and process): {:.3f} s'.format(time.perf_counter() - start))
+
+        start = time.perf_counter()
+        covid_data.get_inputs('JHU')
+        print('JHU refresh check, unchanged: {:.1f} ms'.format(1000*(time.perf_counter() - start)))
+        set_widget(app, 'rb_who_jhu', 0)
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+
+def time_states(app, path, days):
+    # Drill into the US, timing the first load of its states from the county files and then the
+    # one kept, checking the states against their counties
+    covid_data = sys.modules['covid_data']
+    make_states(days, path)
+    covid_data.sources['JHU'] = [os.path.join(path, 'time_series_covid19_' + name + '_global.csv') for name in ['confirmed', 'deaths']]
+    covid_data.sources['JHU US'] = [os.path.join(path, 'time_series_covid19_' + name + '_US.csv') for name in ['confirmed', 'deaths']]
+    country = 'United States of America'
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        set_widget(app, 'rb_who_jhu', 1)
+        set_widget(app, 'tog_states', True)
+        polygons = app['data']['patches']['Country'][country].tolist()
+        for name in ['load', 'kept']:
+            start = time.perf_counter()
+            app['source_map'].selected.indices = polygons
+            future = covid_data.get_states(country, app['data']['bounds'][country])
+            future.result()
+            app['loaded_states'](future)
+            print('Drill into the US states, {}: {:.3f} s'.format(name, time.perf_counter() - start))
+            assert app['states']['country'] == country and len(app['source_states'].data['xs']) == 50
+            app['source_map'].selected.indices = []
+            assert app['states'] is None
+
+        counties = pd.read_csv(covid_data.sources['JHU US'][0])
+        df = covid_data.states[country]['src']
+        expected = counties.groupby('Province_State')[counties.columns[-1]].sum()
+        found = df[df['Date'] == df['Date'].max()].set_index('Country')['Cases_Tot_Abs']
+        assert (found.reindex(expected.index) == expected).all()
+
+        # A state clicked on is plotted on its own
+        app['source_map'].selected.indices = polygons
+        app['source_states'].selected.indices = [3]
+        assert app['df_grp']['Country'].unique().tolist() == ['State 3']
+        set_widget(app, 'tog_states', False)
+        assert app['states'] is None and len(app['source_states'].data['xs']) == 0
+        app['source_map'].selected.indices = []
+        set_widget(app, 'rb_who_jhu', 0)
+    finally:
+        os.chdir(cwd)
+
+def time_startup(path):
+    # Import of covid_data and loading of the WHO data by a new server process, with the shapes
+    # compiled and then from the shapefile (the processed data being cached for both)
+    code = ('import sys, time\n'
+            'start = time.perf_counter()\n'
+            'import covid_data\n'
+            'imported = time.perf_counter()\n'
+            'covid_data.get_data("WHO", "110m")\n'
+            'print(imported - start, time.perf_counter() - imported, "geopandas" in sys.modules)\n')
+    env = dict(os.environ, PYTHONPATH=app_dir)
+    for name in ['compiled shapes', 'shapefile']:
+        if name == 'shapefile':
+            os.remove(os.path.join(path, 'geo_who_110m.npz'))
+        output = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], cwd=path, env=env,
+                                stdout=subprocess.PIPE, check=True).stdout.decode().split()
+        print('Startup from the {}: import {:.3f} s, WHO data {:.3f} s, geopandas imported: {}'.format(name, *map(float, output[:2]), output[2]))
+
+def get_func(app, name):
+    # Data functions moved from the app script into covid_data, look in both
+    if name in app:
+        return app[name]
+    return getattr(sys.modules['covid_data'], name)
+
+def load_who(path):
+    # The WHO data as the server loads it, fetched (hashed) from the file and processed,
+    # with nothing fetched or cached before
+    covid_data = sys.modules['covid_data']
+    covid_data.fetched.clear()
+    covid_data.cache_dir = tempfile.mkdtemp(dir=path)
+    return covid_data.get_src('WHO', '110m', covid_data.get_inputs('WHO'))
+
+def time_load(app, path, days, count=None):
+    # Time the WHO loader on a history of the given length, then its peak memory (MB)
+    make_who(get_countries(count), days, path)
+    covid_data = sys.modules['covid_data']
+    cache_dir = covid_data.cache_dir
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        start = time.perf_counter()
+        load_who(path)
+        seconds = time.perf_counter() - start
+        tracemalloc.start()
+        try:
+            load_who(path)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return seconds, peak / 2**20
+    finally:
+        covid_data.cache_dir = cache_dir
+        os.chdir(cwd)
+
+def report_memory(app, path):
+    # Memory of the shared WHO data, before and after get_compact
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        covid_data = sys.modules['covid_data']
+        df = covid_data.add_capita(covid_data.add_rates(covid_data.get_who('110m')))
+        memory = covid_data.get_memory
+        print('Memory of df_src: {:.2f} MB, {:.2f} MB with compact types'.format(memory(df), memory(app['df_src'])))
+    finally:
+        os.chdir(cwd)
+
+def time_extremes(app):
+    # Time the color scale bounds of the cube
+    cube = app['data']['cube']
+    start = time.perf_counter()
+    sys.modules['covid_data'].get_extremes(cube)
+    return time.perf_counter() - start
+
+def time_totals(app):
+    # Time the world and region totals
+    df_src = app['df_src']
+    start = time.perf_counter()
+    sys.modules['covid_data'].get_totals(df_src)
+    return time.perf_counter() - start
+
+def time_rates(app):
+    # Time the rates of all the countries
+    df_src = app['df_src']
+    start = time.perf_counter()
+    sys.modules['covid_data'].add_rates(df_src.copy())
+    return time.perf_counter() - start
+
+def time_metrics(app, path, file, dates):
+    # A session with the metrics on, against this one without, then the metrics as served
+    covid_metrics = sys.modules['covid_metrics']
+    covid_metrics.enabled = True
+    try:
+        metered = load_app(path, file)
+    finally:
+        covid_metrics.enabled = False
+
+    for session, name in [(app, 'update_map'), (metered, 'update_map, metrics on')]:
+        def slide(date):
+            session['slider'].value = date
+            session['update_map']('value', None, None)
+        report(name, *time_frames(slide, dates))
+
+    server = covid_metrics.start_server(0)
+    try:
+        with urlopen('http://127.0.0.1:{}/metrics'.format(server.server_port)) as response:
+            text = response.read().decode('utf-8')
+    finally:
+        server.shutdown()
+        covid_metrics.server = None
+    assert 'covid_seconds_count{{name="update_map"}} {}'.format(len(dates)) in text
+    assert 'covid_bytes_count{name="source_map"}' in text
+    print('Metrics served: {} lines'.format(len(text.splitlines())))
+
+def time_jhu(app, path):
+    # Time the JHU loader on the local files
+    cases = os.path.join(path, 'time_series_covid19_confirmed_global.csv')
+    deaths = os.path.join(path, 'time_series_covid19_deaths_global.csv')
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        start = time.perf_counter()
+        get_func(app, 'get_jhu')('110m', cases, deaths)
+        return time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+
+def merge_map(app, date):
+    # The map frame as it was built before the date cube, for comparison
+    df = app['df_geo'].copy()
+    df_src = app['df_src']
+    var_abs = [var for var in app['plot_var'] if var.endswith('_Abs')]
+    df = df.merge(df_src[df_src['Date'] == date][['Country'] + var_abs],
+                  left_on = 'Country', right_on = 'Country', how = 'left')
+    for var in var_abs:
+        df[var[:-4] + '_Rel'] = 100000*df[var]/df['Population']
+    df['Selected'] = df[app['plot_var'][app['sel_var']]]
+    df.fillna(0, inplace = True)
+    return df
+
+class Payload:
+    # Count the bytes the document changes would send over the websocket
+    def __init__(self, doc):
+        self.bytes = 0
+        doc.on_change(self.count)
+
+    def count(self, event):
+        # Callbacks added to the document are not sent
+        if not hasattr(event, 'generate'):
+            return
+        patch, buffers = process_document_events([event], use_buffers=True)
+        self.bytes += len(patch) + sum(len(payload) for header, payload in buffers)
+
+def time_outlines(app, path, payload, hi_res):
+    # Outlines sent at each detail level, against the full precision float64 coordinates
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        set_widget(app, 'tog_res', hi_res)
+        geo = '50m' if hi_res else '110m'
+        df = gpd.read_file('ne_' + geo + '_admin_0_countries.shp').explode()
+        raw = [np.asarray(polygon.exterior.coords.xy) for polygon in df.geometry]
+        payload.bytes = 0
+        app['source_map'].data.update(xs = [xy[0] for xy in raw], ys = [xy[1] for xy in raw])
+        report_outlines(geo + ' full', sum(xy.shape[1] for xy in raw), payload.bytes)
+
+        for level in reversed(range(len(app['geo_tolerance']))):
+            xs, ys = app['data']['outlines'][level]
+            payload.bytes = 0
+            app['source_map'].data.update(xs = xs, ys = ys)
+            report_outlines('{} level {} ({})'.format(geo, level, app['geo_tolerance'][level]), sum(map(len, xs)), payload.bytes)
+    finally:
+        set_widget(app, 'tog_res', False)
+        os.chdir(cwd)
+
+def report_outlines(name, points, sent):
+    print('{:<24} {:>10} {:>12}'.format(name, points, sent))
+
+def time_series(app, payload):
+    # Plot series of 20 countries as sent, against all of df_grp, and zoomed into a tenth of
+    # the dates, checking the downsampling keeps the ends and a spike of a series
+    polygons = app['data']['patches']['Country']
+    indices = sorted(np.concatenate([polygons[country] for country in list(polygons)[:20]]).tolist())
+    payload.bytes = 0
+    app['source_map'].selected.indices = indices
+    sent = payload.bytes
+    payload.bytes = 0
+    app['source_grp'].data = dict(app['ColumnDataSource'].from_df(app['df_grp']))
+    print('update_plot, 20 countries: {} bytes sent, {} with all of df_grp'.format(sent, payload.bytes))
+
+    x_range = app['p_lin'].x_range
+    first = app['df_grp']['Date'].min().value / 1e6
+    last = app['df_grp']['Date'].max().value / 1e6
+    payload.bytes = 0
+    start = time.perf_counter()
+    x_range.update(start = first + 0.45*(last - first), end = first + 0.55*(last - first))
+    print('Zoom into a tenth of the dates: {:.1f} ms, {} points, {} bytes sent'.format(
+          1000*(time.perf_counter() - start), len(app['source_grp'].data['Date']), payload.bytes))
+    x_range.update(start = first - 86400e3, end = last + 86400e3)
+    assert app['plot_window'] is None
+    points = len(app['source_grp'].data['Date'])
+
+    # Panned past the last date, and to where only some of the series have dates, with
+    # the series still sent as downsampled
+    x_range.update(start = last + 5*86400e3, end = last + 30*86400e3)
+    assert app['plot_window'] is not None and len(app['source_grp'].data['Date']) == points
+    app['df_grp'] = app['df_grp'][~((app['df_grp']['Country'] == app['df_grp']['Country'].iloc[0]) &
+                                    (app['df_grp']['Date'] > app['df_grp']['Date'].min() + timedelta(10)))]
+    x_range.update(start = last - 30*86400e3, end = last)
+    assert len(app['source_grp'].data['Date']) > 0
+    x_range.update(start = first - 86400e3, end = last + 86400e3)
+    app['source_map'].selected.indices = []
+
+    x = np.arange(5000.0)
+    y = np.sin(x / 100)
+    y[1234] = 10
+    kept = app['get_lttb'](x[None], y[None], app['plot_points'])[0]
+    assert len(kept) == app['plot_points'] and kept[0] == 0 and kept[-1] == len(x) - 1 and 1234 in kept
+    assert (kept == lttb(x, y, app['plot_points'])).all()
+
+def lttb(x, y, points):
+    # Largest triangle three buckets as usually written, one bucket after the other, for comparison
+    edges = np.linspace(1, len(x) - 1, points - 1).astype(int)
+    kept = [0]
+    for i in range(points - 2):
+        if i + 2 < len(edges):
+            next_x, next_y = x[edges[i + 1]:edges[i + 2]].mean(), y[edges[i + 1]:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        bucket = slice(edges[i], edges[i + 1])
+        area = np.abs((x[kept[-1]] - next_x)*(y[bucket] - y[kept[-1]]) - (x[kept[-1]] - x[bucket])*(next_y - y[kept[-1]]))
+        kept.append(edges[i] + np.argmax(area))
+
+    return np.array(kept + [len(x) - 1])
+
+def time_frames(func, dates, payload=None):
+    times = []
+    sent = []
+    for date in dates:
+        if payload:
+            payload.bytes = 0
+        start = time.perf_counter()
+        func(date)
+        times.append(time.perf_counter() - start)
+        if payload:
+            sent.append(payload.bytes)
+    return 1000*np.array(times), np.array(sent)
+
+def report(name, times, sent=[]):
+    print('{:<24} {:>10.3f} {:>10.3f} {:>10.3f} {:>12}'.format(name, np.mean(times), np.median(times), np.max(times),
+                                                              '{:.0f}'.format(np.mean(sent)) if len(sent) else '-'))
+
+##################################################
+# Suite compared against a baseline
+##################################################
+
+# Measures of the suite are regressions past a fraction (--tolerance), and these amounts, above the baseline
+slack = {'ms' : 1, 'peak_kb' : 64, 'bytes' : 0}
+
+def measure(func, repeat, payload):
+    # Median wall time (ms) of a few calls, then the peak memory (kB) and bytes sent of
+    # one more call with the allocations traced, which slows it down
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(i)
+        times.append(time.perf_counter() - start)
+    payload.bytes = 0
+    tracemalloc.start()
+    try:
+        func(repeat)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {'ms' : 1000*np.median(times), 'peak_kb' : peak / 1024, 'bytes' : payload.bytes}
+
+def run_suite(app, path, payload, repeat):
+    # The loaders on the synthetic files, then the functions and callbacks of a session
+    cases = os.path.join(path, 'time_series_covid19_confirmed_global.csv')
+    deaths = os.path.join(path, 'time_series_covid19_deaths_global.csv')
+    dates = pd.date_range(app['first_dt'], app['last_dt'])
+    source_map = app['source_map']
+    rb_cases_deaths = app['rb_cases_deaths']
+
+    def slide(i):
+        app['slider'].value = dates[(i*37) % len(dates)]
+        app['update_map']('value', None, None)
+
+    def select(i):
+        # A country, then two others, the first polygon of each being clicked
+        source_map.selected.indices = [[3], [10, 40]][i % 2]
+
+    def toggle(i):
+        rb_cases_deaths.active = 1 - rb_cases_deaths.active
+
+    suite = [('get_who', lambda i: get_func(app, 'get_who')('110m')),
+             ('get_jhu', lambda i: get_func(app, 'get_jhu')('110m', cases, deaths)),
+             ('get_geo', lambda i: get_func(app, 'get_geo')('WHO', '110m')),
+             ('get_map', lambda i: app['get_map'](dates[(i*37) % len(dates)])),
+             ('get_stats', lambda i: app['get_stats']()),
+             ('update_map', slide),
+             ('update_plot', select),
+             ('change_var', toggle)]
+
+    results = {}
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        for name, func in suite:
+            results[name] = measure(func, repeat, payload)
+    finally:
+        os.chdir(cwd)
+        source_map.selected.indices = []
+
+    print('{:<24} {:>10} {:>10} {:>12}'.format('Suite', 'ms', 'peak kB', 'bytes sent'))
+    for name, result in results.items():
+        print('{:<24} {:>10.3f} {:>10.0f} {:>12}'.format(name, result['ms'], result['peak_kb'], result['bytes']))
+
+    return results
+
+def compare(results, baseline, tolerance):
+    # Measures above the baseline by more than the tolerance, reported as regressions
+    regressions = []
+    for name, result in results.items():
+        for key, value in result.items():
+            old = baseline['results'].get(name, {}).get(key)
+            if old is not None and value > max(old*(1 + tolerance), old + slack[key]):
+                regressions.append('{} {}: {:.1f} -> {:.1f}'.format(name, key, old, value))
+
+    return regressions
+
+def report_all(app, path, payload, args):
+    # Everything timed beyond the suite, with the ways it was done before where they are kept
+    dates = [app['first_dt'] + timedelta(int(i)) for i in np.linspace(0, args.days - 1, args.frames)]
+    slider = app['slider']
+
+    def slide(date):
+        slider.value = date
+        app['update_map']('value', None, None)
+
+    print('{:<24} {:>10} {:>10} {:>10} {:>12}'.format('Per frame (ms)', 'mean', 'median', 'max', 'bytes sent'))
+    report('merge (before)', *time_frames(lambda date: merge_map(app, date), dates))
+    report('get_map', *time_frames(app['get_map'], dates))
+    report('update_map', *time_frames(slide, dates, payload))
+
+    # Playback ticks, each one a frame late so that a new frame is due
+    if 'play_from' in app:
+        def tick(date):
+            app['play']['time'] -= 1 / app['play_fps']
+            app['animate_update']()
+
+        app['play_from'](app['first_dt'])
+        report('animate_update', *time_frames(tick, range(min(args.frames, args.days - 2)), payload))
+
+    # Buttons changing the variable or its scale, then the resolution (loaded beforehand)
+    def toggle(step):
+        set_widget(app, *step)
+
+    report('change_var', *time_frames(toggle, [('rb_cases_deaths', 1), ('rb_tot_new', 2), ('rb_abs_rel', 1),
+                                               ('tog_lin', True), ('tog_lin', False), ('rb_abs_rel', 0),
+                                               ('rb_tot_new', 0), ('rb_cases_deaths', 0)], payload))
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        sys.modules['covid_data'].get_data('WHO', '50m')
+        report('change_src', *time_frames(toggle, [('tog_res', True), ('tog_res', False)] * 2, payload))
+    finally:
+        os.chdir(cwd)
+
+    if 'get_plot' in app:
+        time_series(app, payload)
+
+    if 'geo_tolerance' in app:
+        print('{:<24} {:>10} {:>12}'.format('Outlines', 'points', 'bytes sent'))
+        for hi_res in [False, True]:
+            time_outlines(app, path, payload, hi_res)
+
+    if 'loaded_src' in app:
+        time_src(app, path)
+
+    time_startup(path)
+
+    if 'loaded_states' in app:
+        time_states(app, path, args.days)
+
+    if 'covid_metrics' in sys.modules:
+        time_metrics(app, path, args.app, dates)
+
+    report_memory(app, path)
+    print('get_extremes, {} days: {:.3f} s'.format(args.days, time_extremes(app)))
+    print('add_rates, {} days: {:.3f} s'.format(args.days, time_rates(app)))
+    print('get_totals, {} days: {:.3f} s'.format(args.days, time_totals(app)))
+
+    for days in [args.days, 10*args.days]:
+        print('get_who, {} days: {:.3f} s, peak {:.1f} MB'.format(days, *time_load(app, path, days, args.countries)))
+
+    print('get_jhu, {} days: {:.3f} s'.format(args.days, time_jhu(app, path)))
+
+    # Another session in the same server process
+    start = time.perf_counter()
+    load_app(path, args.app)
+    print('Next session: {:.3f} s'.format(time.perf_counter() - start))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the COVID-19 dashboard on synthetic data')
+    parser.add_argument('--days', type=int, default=300, help='number of days of history')
+    parser.add_argument('--frames', type=int, default=50, help='number of map frames to time')
+    parser.add_argument('--countries', type=int, default=None,
+                        help='number of countries, made up ones past those of Countries.csv (default: all of those)')
+    parser.add_argument('--app', default=os.path.join(app_dir, 'COVID-19.py'),
+                        help='app script to run, e.g. an older revision to compare against')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed calls of each function of the suite')
+    parser.add_argument('--save', help='file to save the results of the suite to, as a baseline')
+    parser.add_argument('--baseline', help='file of a saved baseline, exiting with status 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='fraction above the baseline that is a regression (default: 0.5)')
+    parser.add_argument('--suite-only', action='store_true', help='only run the suite')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline['days'], baseline['countries']) != (args.days, args.countries):
+            sys.exit('Baseline is of {} days and {} countries, run with the same'.format(baseline['days'], baseline['countries']))
+
+    path = make_data(args.days, args.countries)
+    try:
+        start = time.perf_counter()
+        app = load_app(path, args.app)
+        print('Startup: {:.3f} s'.format(time.perf_counter() - start))
+
+        payload = Payload(app['curdoc']())
+        results = run_suite(app, path, payload, args.repeat)
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump({'days' : args.days, 'countries' : args.countries, 'results' : results}, f, indent=2)
+        if not args.suite_only:
+            report_all(app, path, payload, args)
+    finally:
+        shutil.rmtree(path)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+        print('No regressions against ' + args.baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+import covid_data
+
+# Compile the map shapes of each source and resolution into the files read at startup, so that
+# the server never imports geopandas (see covid_data.get_geo). Run it where the shapefiles are,
+# after downloading them, and ship the geo_*.npz files with the app:
+#   python build_geo.py
+
+if __name__ == '__main__':
+    for source in ['WHO', 'JHU']:
+        for resolution in ['110m', '50m']:
+            covid_data.build_geo(source, resolution)
+            print('Compiled ' + covid_data.geo_file.format(source.lower(), resolution))
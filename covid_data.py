@@ -0,0 +1,875 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from covid_metrics import timed
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import hashlib
+import io
+import logging
+import numpy as np
+import os
+import pandas as pd
+import tempfile
+import threading
+import time
+import zipfile
+
+# Loading and processing of the data behind the dashboard. This module is imported
+# once per server process, so anything kept here is shared by all the sessions.
+
+who_file = 'WHO-COVID-19-global-data.csv'
+jhu_cases = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_global.csv'
+jhu_deaths = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_deaths_global.csv'
+jhu_us_cases = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_US.csv'
+jhu_us_deaths = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_deaths_US.csv'
+
+# Columns read from the WHO file by their header, so a change to it fails rather than shifting
+# the columns, with their names here and types. The file is read who_chunk lines at a time.
+who_columns = {'Date_reported' : 'Date', 'Country' : 'Country', 'New_cases' : 'Cases_New_Abs',
+               'Cumulative_cases' : 'Cases_Tot_Abs', 'New_deaths' : 'Deaths_New_Abs', 'Cumulative_deaths' : 'Deaths_Tot_Abs'}
+who_types = {'Date_reported' : str, 'Country' : str, 'New_cases' : np.float64,
+             'Cumulative_cases' : np.float64, 'New_deaths' : np.float64, 'Cumulative_deaths' : np.float64}
+who_chunk = 100000
+
+# Files or URLs each source is read from, replaced by local stand-ins for testing
+sources = {'WHO' : [who_file], 'JHU' : [jhu_cases, jhu_deaths], 'JHU US' : [jhu_us_cases, jhu_us_deaths]}
+
+# Countries whose states (admin-1) JHU has, loaded when drilling into one of them, those of the
+# US summed from its counties. The states of the states_kept most recently used ones are kept.
+state_countries = ['Australia', 'Canada', 'China', 'United States of America']
+states_file = 'ne_10m_admin_1_states_provinces.shp'
+states_kept = 8
+
+# Loaded datasets are checked for new data this often (seconds), downloading only what changed
+refresh_period = 3600
+fetch_timeout = 60
+
+# Processed data is kept here, oldest entries are removed past the size limit
+cache_dir = 'cache'
+cache_size = 500*1024*1024
+
+# Days in each rolling average of the daily numbers, all computed in one pass by get_rolling
+avg_days = {'Avg' : 7, 'Avg14' : 14, 'Avg28' : 28}
+
+# Days between the 7 day averages compared for the growth rate and the week over week change,
+# and the serial interval the reproduction number is estimated over, see get_rates
+rate_days = 7
+serial_days = 4
+
+# Statistics computed from the counts rather than counted, which are the same per 100k
+count_stat = ['Tot', 'New'] + list(avg_days)
+rate_stat = ['Growth', 'Doubling', 'WoW', 'Rt', 'CFR']
+
+# Every variable that can be shown, ordered by cases/deaths, per region/per 100k, then statistic
+plot_stat = count_stat + rate_stat
+plot_var = [measure + '_' + stat + '_' + scale for measure in ['Cases', 'Deaths'] for scale in ['Abs', 'Rel'] for stat in plot_stat]
+
+# Variables in the cube of the map, the rates only once as they are the same per 100k, and the
+# column of each of plot_var in it
+cube_var = [var for var in plot_var if var.endswith('_Abs') or var.split('_')[1] not in rate_stat]
+cube_index = [cube_var.index(var[:-4] + '_Abs' if var.split('_')[1] in rate_stat else var) for var in plot_var]
+
+# Rates which fall as well as rise, shown on a scale centred on 0
+signed_stat = ['Growth', 'WoW']
+
+# Quantiles the clipped color scale spans, leaving out the few countries far off the rest
+scale_quantiles = [0.02, 0.98]
+
+# Map outline detail levels, from the full shapes to the ones shown zoomed out. The tolerance
+# (in degrees) of each level is about the size of a pixel at the zoom it is shown at, and the
+# coordinates are rounded to geo_digits decimals (about 100 m)
+geo_tolerance = [0, 0.05, 0.2]
+geo_digits = 3
+
+# Shapes of the map compiled by build_geo for each source and resolution, so that they are read
+# at startup without geopandas (compiled again from the shapefile when out of date)
+geo_file = 'geo_{}_{}.npz'
+
+log = logging.getLogger(__name__)
+
+# Names matched up so far for each list of aliases, see get_names
+names_seen = {}
+
+# Inputs and validators of each file or URL, see fetch
+fetched = {}
+
+# Loading is done on a thread pool so that it never blocks the server, see get_future
+load_pool = ThreadPoolExecutor(max_workers=2)
+fetch_pool = ThreadPoolExecutor(max_workers=4)
+loading = {}
+refresh_thread = None
+
+# Loaded data for each (source, resolution), see get_data
+datasets = {}
+datasets_lock = threading.Lock()
+
+# Loaded states of each country, least recently used first, see get_states
+states = OrderedDict()
+states_loading = {}
+states_lock = threading.Lock()
+
+##################################################
+# Functions to match country names between sources
+##################################################
+
+def get_aliases(source, resolution=None):
+    # Ordered (pattern, replacement) pairs for a source, followed by the subunits
+    # which are merged into their country at this resolution
+    df = df_alias[df_alias['Source'] == source]
+    aliases = list(zip(df['Name'], df['Country']))
+    if resolution:
+        df = df_sub[(df_sub[resolution] == 'No') & (df_sub['Subunit'] != df_sub['Country'])]
+        aliases = aliases + list(zip(df['Subunit'], df['Country']))
+
+    return aliases
+
+def get_names(names, aliases):
+    # Apply the aliases in order to each distinct name not seen before, then map back onto every row
+    seen = names_seen.setdefault(tuple(aliases), {})
+    unique = pd.Series([name for name in names.dropna().unique() if name not in seen], dtype=object)
+    if len(unique):
+        fixed = unique.copy()
+        for pattern, replacement in aliases:
+            fixed = fixed.str.replace(pattern, replacement, regex=True)
+        seen.update(zip(unique, fixed))
+
+    return names.map(seen)
+
+##################################################
+# Function to get the WHO data from disk
+##################################################
+
+def read_who(file, aliases):
+    # Sum each chunk of the file by date and country as it is read, so only one chunk of
+    # lines is held at a time besides the sums. The counts are read as floats, as some may
+    # be missing, and are whole numbers again once summed.
+    sums = []
+    for df in pd.read_csv(file, encoding='utf-8', error_bad_lines=False, skipinitialspace=True,
+                          usecols=list(who_columns), dtype=who_types, chunksize=who_chunk):
+        df = df[list(who_columns)].rename(columns=who_columns)
+        df['Date'] = pd.to_datetime(df['Date'])
+        df['Country'] = get_names(df['Country'], aliases)
+        sums.append(df.groupby(['Date', 'Country']).sum().astype(np.int64))
+
+    # Only the dates of a country found in more than one chunk (its subunits) are summed again
+    df = pd.concat(sums)
+    del sums
+    repeated = df.index.duplicated(keep=False)
+    df = pd.concat([df[~repeated], df[repeated].groupby(level=['Date', 'Country']).sum()])
+
+    return df.sort_index(level=['Country', 'Date']).reset_index()
+
+@timed
+def get_who(resolution, file=who_file):
+    return add_rolling(read_who(file, get_aliases('WHO', resolution)))
+
+def add_rolling(df):
+    # Place the daily numbers on a dense (country x date) grid for the rolling averages,
+    # keeping track of which days are actually in the data
+    index_country = pd.factorize(df['Country'])[0]
+    index_dt = (df['Date'] - df['Date'].min()).dt.days.to_numpy()
+    present = np.zeros((index_country.max() + 1, index_dt.max() + 1), dtype=bool)
+    present[index_country, index_dt] = True
+    for name in ['Cases', 'Deaths']:
+        new = np.zeros(present.shape, dtype=df[name + '_New_Abs'].dtype)
+        new[index_country, index_dt] = df[name + '_New_Abs'].to_numpy()
+        for stat, avg in get_rolling(new, present).items():
+            df[name + '_' + stat + '_Abs'] = avg[index_country, index_dt]
+
+    return df
+
+def get_rolling(new, present=None):
+    # Mean of the daily numbers over each window in avg_days, from differences of the
+    # running sums along the dates of a dense (country x date) table. Days which are not
+    # present are left out, like a time based window, otherwise the first days of the
+    # table are averaged over as many days as there are so far.
+    total = np.cumsum(new, axis=1)
+    if present is None:
+        count_total = np.arange(1, new.shape[1] + 1)
+    else:
+        count_total = np.cumsum(present, axis=1)
+
+    rolling = {}
+    for stat, days in avg_days.items():
+        window = total.copy()
+        window[:, days:] -= total[:, :-days]
+        count = count_total.copy()
+        count[..., days:] -= count_total[..., :-days]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rolling[stat] = window/count
+
+    return rolling
+
+def add_rates(df):
+    # Place the 7 day averages on a dense (country x date) grid to compute the statistics
+    # of rate_stat for all the countries at once
+    index_country = pd.factorize(df['Country'])[0]
+    index_dt = (df['Date'] - df['Date'].min()).dt.days.to_numpy()
+    for name in ['Cases', 'Deaths']:
+        avg = np.full((index_country.max() + 1, index_dt.max() + 1), np.nan)
+        avg[index_country, index_dt] = df[name + '_Avg_Abs'].to_numpy()
+        for stat, values in get_rates(avg).items():
+            df[name + '_' + stat + '_Abs'] = values[index_country, index_dt]
+
+    # Deaths per 100 cases, the same whichever is shown
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = 100*df['Deaths_Tot_Abs'].to_numpy(dtype=float)/df['Cases_Tot_Abs'].to_numpy()
+    df['Cases_CFR_Abs'] = df['Deaths_CFR_Abs'] = np.where(np.isfinite(ratio), ratio, np.nan)
+
+    return df
+
+def get_rates(avg):
+    # Growth of the 7 day averages of a dense (country x date) table over rate_days, as a daily
+    # rate (%), the days they take to double at that rate (none when falling), their change over
+    # the week (%), and the reproduction number estimated without the tests from the ratio of the
+    # averages a serial interval apart. Missing or zero averages give no value (NaN).
+    with np.errstate(divide='ignore', invalid='ignore'):
+        week = np.full(avg.shape, np.nan)
+        week[:, rate_days:] = avg[:, rate_days:]/avg[:, :-rate_days]
+        serial = np.full(avg.shape, np.nan)
+        serial[:, serial_days:] = avg[:, serial_days:]/avg[:, :-serial_days]
+        week[~np.isfinite(week)] = np.nan
+        serial[~np.isfinite(serial) | (serial == 0)] = np.nan
+        rate = np.log(week)/rate_days
+        rates = {'Growth' : 100*np.expm1(rate), 'Doubling' : np.where(rate > 0, np.log(2)/rate, np.nan),
+                 'WoW' : 100*(week - 1), 'Rt' : serial}
+
+    return rates
+
+def is_rate(var):
+    return var.split('_')[1] in rate_stat
+
+def is_signed(var):
+    return var.split('_')[1] in signed_stat
+
+##################################################
+# Function to get the JHU data from the web
+##################################################
+
+def pull_jhu(location, resolution):
+    df = pd.read_csv(location, encoding='utf-8', error_bad_lines=False)
+    
+    df['Province/State'] = get_names(df['Province/State'], get_aliases('JHU Province'))
+
+    # Provinces are counted as their own country, apart from in these three
+    is_province = df['Province/State'].notnull() & ~df['Country/Region'].isin(['Australia', 'Canada', 'China'])
+    df.loc[is_province, 'Country/Region'] = df.loc[is_province, 'Province/State']
+
+    df.drop(df.columns[[0,2,3]], axis=1, inplace=True)
+    df.rename(columns = {df.columns[0]:'Country'}, inplace=True)
+
+    df['Country'] = get_names(df['Country'], get_aliases('JHU', resolution))
+
+    df = df.groupby('Country').sum()
+    
+    df.columns = pd.to_datetime(df.columns, format='%m/%d/%y').tolist()
+    df.reset_index(inplace = True)
+
+    return df
+
+@timed
+def get_jhu(resolution, cases=jhu_cases, deaths=jhu_deaths):
+    df_cases = pull_jhu(cases, resolution).set_index('Country')
+    df_deaths = pull_jhu(deaths, resolution).set_index('Country')
+    df_deaths = df_deaths.reindex(index=df_cases.index, columns=df_cases.columns, fill_value=0)
+
+    return long_jhu(df_cases, df_deaths)
+
+def long_jhu(df_cases, df_deaths):
+    # Day to day changes along the date axis of the wide (country x date) tables,
+    # the first day has no change, then one long frame sorted by country and date
+    countries = df_cases.index.to_numpy()
+    dates = pd.DatetimeIndex(df_cases.columns)
+    values = {}
+    for name, df in [('Cases', df_cases), ('Deaths', df_deaths)]:
+        total = df.to_numpy()
+        new = np.diff(total, axis=1, prepend=total[:, :1])
+        values[name + '_Tot_Abs'] = total.ravel()
+        values[name + '_New_Abs'] = new.ravel()
+        for stat, avg in get_rolling(new).items():
+            values[name + '_' + stat + '_Abs'] = avg.ravel()
+
+    # Position each row had in the date by date layout this used to be built from
+    index = np.arange(len(dates))*len(countries) + np.arange(len(countries))[:, None]
+
+    df = pd.DataFrame({'index' : index.ravel(), 'Date' : np.tile(dates, len(countries)),
+                       'Country' : np.repeat(countries, len(dates))})
+    for name in ['Cases', 'Deaths']:
+        for stat in count_stat:
+            df[name + '_' + stat + '_Abs'] = values[name + '_' + stat + '_Abs']
+
+    return df
+
+##################################################
+# Functions to cache the processed data on disk
+##################################################
+
+def get_src(source, resolution, data):
+    # Processed data for the source, read from the cache
+    # when neither the input data nor the way it is processed has changed
+    name = source.lower()
+    sha = hashlib.sha1(resolution.encode())
+    for digest, content in data:
+        sha.update(digest)
+    for file in [__file__, 'Aliases.csv', 'Subunits_and_small_shapes.csv']:
+        update_hash(sha, file)
+    prefix = name + '_' + resolution + '_'
+    file = os.path.join(cache_dir, prefix + sha.hexdigest() + '.npz')
+
+    frames = read_cache(file)
+    if frames:
+        return frames['src']
+
+    if source == 'JHU':
+        df_src = get_jhu(resolution, get_reader(data[0]), get_reader(data[1]))
+    else:
+        df_src = get_who(resolution, get_reader(data[0]))
+    write_cache(file, prefix, src=df_src)
+
+    return df_src
+
+def fetch(location):
+    # Input of a file or URL, its digest and what to read it from, only read again when it
+    # has changed: the file's modification time and size or the URL's ETag/Last-Modified tell
+    # the server what we have. A file is hashed a block at a time and then read from its path,
+    # so it is never held in memory whole, a URL's contents are kept.
+    cached = fetched.get(location)
+    if '://' not in location:
+        stat = os.stat(location)
+        modified = (stat.st_mtime, stat.st_size)
+        if cached and cached[0] == modified:
+            return cached[1]
+        fetched[location] = (modified, (update_hash(hashlib.sha1(), location).digest(), location))
+        return fetched[location][1]
+
+    request = Request(location)
+    if cached:
+        etag, modified = cached[0]
+        if etag:
+            request.add_header('If-None-Match', etag)
+        if modified:
+            request.add_header('If-Modified-Since', modified)
+    try:
+        with urlopen(request, timeout=fetch_timeout) as response:
+            content = response.read()
+            fetched[location] = ((response.headers.get('ETag'), response.headers.get('Last-Modified')),
+                                 (hashlib.sha1(content).digest(), content))
+    except HTTPError as error:
+        if error.code == 304 and cached:
+            return cached[1]
+        raise
+
+    return fetched[location][1]
+
+def get_reader(data):
+    # What pandas reads an input from: the path of a file or the contents of a URL
+    digest, content = data
+    return io.BytesIO(content) if isinstance(content, bytes) else content
+
+def update_hash(sha, file):
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+
+    return sha
+
+def save_frames(file, **frames):
+    # Frames stored as one array per column, read back by read_cache
+    arrays = {}
+    for name, df in frames.items():
+        for column in df.columns:
+            values = df[column].to_numpy()
+            if values.dtype == object:
+                values = values.astype(str)
+            arrays[name + '/' + column] = values
+
+    # Write to a temporary file of this writer first, so that other sessions and server
+    # processes never see a partial entry
+    fd, temp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(file) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp, file)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+def read_cache(file):
+    # Frames stored as one array per column, None if missing or unreadable
+    try:
+        with np.load(file) as npz:
+            frames = {}
+            for key in npz.files:
+                name, column = key.split('/', 1)
+                values = npz[key]
+                if values.dtype.kind == 'U':
+                    values = values.astype(object)
+                frames.setdefault(name, {})[column] = values
+
+        # Mark as recently used, unless another process has just removed it
+        os.utime(file)
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        return None
+
+    return {name : pd.DataFrame(columns) for name, columns in frames.items()}
+
+def write_cache(file, prefix, **frames):
+    os.makedirs(cache_dir, exist_ok=True)
+    save_frames(file, **frames)
+
+    # Entries for older inputs of this source are stale, then evict least recently used.
+    # Other server processes may be removing the same entries.
+    entries = []
+    for entry in os.listdir(cache_dir):
+        if entry.endswith('.npz'):
+            try:
+                stat = os.stat(os.path.join(cache_dir, entry))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(cache_dir, entry)))
+    total = 0
+    for mtime, size, entry in sorted(entries, reverse=True):
+        total += size
+        if entry != file and (os.path.basename(entry).startswith(prefix) or total > cache_size):
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+
+##################################################
+# Functions to get the shapes, compiled once using geopandas
+##################################################
+
+@timed
+def get_geo(source, resolution):
+    # Polygons of the map, one row per exploded polygon with its country, regions, population and
+    # bounds, and their outlines at each detail level. Read from the compiled file with numpy
+    # alone, unless it is missing or the shapefile or name tables changed since.
+    frames = read_cache(geo_file.format(source.lower(), resolution))
+    key = get_geo_key(source, resolution)
+    if not frames or (key is not None and frames['info']['Key'][0] != key):
+        frames = build_geo(source, resolution)
+
+    # Countries without a region are stored as empty names
+    df_geo = frames['geo'].replace({'Continental Region' : {'' : np.nan}, 'Statistical Region' : {'' : np.nan}})
+
+    return df_geo, get_patches(df_geo), split_outlines(frames)
+
+def get_geo_key(source, resolution):
+    # Hash of everything the compiled shapes are made from: the shapes, their names (in the
+    # .dbf), the name tables and this script, None without the shapefile (the compiled file
+    # can be shipped on its own)
+    shapefile = 'ne_' + resolution + '_admin_0_countries.shp'
+    if not os.path.exists(shapefile):
+        return None
+    sha = hashlib.sha1((source + resolution + str(geo_tolerance) + str(geo_digits)).encode())
+    for file in [shapefile, shapefile[:-4] + '.dbf', __file__, 'Aliases.csv', 'Countries.csv']:
+        update_hash(sha, file)
+
+    return sha.hexdigest()
+
+def build_geo(source, resolution):
+    # Compile the shapes into the file read by get_geo: the polygons with their bounds, and the
+    # outlines of each detail level as flat coordinates with the number of points of each polygon
+    df = read_geo(source, resolution)
+    frames = {}
+    for level, tolerance in enumerate(geo_tolerance):
+        frames['xy' + str(level)], frames['n' + str(level)] = get_level(df, tolerance)
+
+    columns = ['Country', 'Continental Region', 'Statistical Region']
+    frames['geo'] = pd.concat([df[columns].fillna(''), df[['Population']], df.geometry.bounds], axis=1)
+    frames['info'] = pd.DataFrame({'Key' : [get_geo_key(source, resolution) or '']})
+    save_frames(geo_file.format(source.lower(), resolution), **frames)
+
+    return frames
+
+def read_geo(source, resolution):
+    # Only compiling the shapes needs geopandas, which is slow to import
+    import geopandas as gpd
+
+    geofile = 'ne_' + resolution + '_admin_0_countries.shp'
+
+    df = gpd.read_file(geofile)[['ADMIN','geometry']]
+    df.columns = ['Country','geometry']
+
+    # 2019 update of Macedonia to North Macedonia
+    df['Country'] = get_names(df['Country'], get_aliases('NE'))
+
+    # Specific for JHU, Channel Islands include Guernsey and Jersey and US includes
+    # Guam, Northern Mariana Islands, Puerto Rico, and United States Virgin Islands
+    if source == 'JHU':
+        df['Country'] = get_names(df['Country'], get_aliases('NE JHU'))
+
+    # Remove Antarctica
+    df.drop(df[df['Country'] == 'Antarctica'].index, inplace = True)
+
+    df = df.merge(df_countries, left_on = 'Country', right_on = 'Country', how = 'left')
+
+    # Fix multipolygon rendering (selecting a polygon selects the other parts through the patches)
+    df = df.explode()
+    df.reset_index(inplace = True)
+
+    return df
+
+def get_patches(df_geo):
+    # Polygons of each country and region, so that selecting one polygon or a whole
+    # region is a lookup, along with the country of each polygon for the reverse
+    patches = {'Polygon' : df_geo['Country'].to_numpy()}
+    for column in [column for column in ['Country', 'Continental Region', 'Statistical Region'] if column in df_geo]:
+        groups = df_geo.groupby(column).indices
+        patches[column] = {name : np.sort(index) for name, index in groups.items()}
+
+    return patches
+
+def split_outlines(frames):
+    # Split the joined coordinates back into one array per polygon, at each detail level
+    outlines = []
+    for level in range(len(geo_tolerance)):
+        split = np.cumsum(frames['n' + str(level)]['Count'].to_numpy())[:-1]
+        xy = frames['xy' + str(level)]
+        outlines.append((np.split(xy['x'].to_numpy(), split), np.split(xy['y'].to_numpy(), split)))
+
+    return outlines
+
+def get_level(df_geo, tolerance):
+    # Outlines simplified to the tolerance, rounded to geo_digits, and without the islands
+    # smaller than the tolerance (the largest polygon of a country is always kept)
+    geometry = df_geo.geometry.simplify(tolerance, preserve_topology=True) if tolerance else df_geo.geometry
+    bounds = df_geo.geometry.bounds
+    extent = np.maximum(bounds['maxx'] - bounds['minx'], bounds['maxy'] - bounds['miny'])
+    area = df_geo.geometry.area
+    largest = area == area.groupby(df_geo['Country']).transform('max')
+    dropped = ((extent < tolerance) & ~largest).to_numpy()
+
+    xs = []
+    ys = []
+    for polygon, drop in zip(geometry, dropped):
+        if drop or polygon.is_empty:
+            x = y = np.zeros(0)
+        else:
+            x, y = np.round(np.asarray(polygon.exterior.coords.xy), geo_digits)
+            # Points made the same by the rounding
+            repeated = np.r_[False, (x[1:] == x[:-1]) & (y[1:] == y[:-1])]
+            x = x[~repeated]
+            y = y[~repeated]
+        xs.append(x)
+        ys.append(y)
+
+    # float32 keeps geo_digits decimals and halves what is sent to the browser
+    df_xy = pd.DataFrame({'x' : np.concatenate(xs).astype(np.float32), 'y' : np.concatenate(ys).astype(np.float32)})
+    df_count = pd.DataFrame({'Count' : [len(x) for x in xs]})
+
+    return df_xy, df_count
+
+@timed
+def get_cube(df_geo, df_src):
+    # Dense (date x country x variable) array of everything the map shows, built once
+    # per data source so that a new date is a slice of it rather than a merge
+    countries = pd.Index(df_geo['Country'].unique())
+    dates = pd.DatetimeIndex(np.sort(df_src['Date'].unique()))
+    population = df_geo.drop_duplicates('Country').set_index('Country')['Population'].reindex(countries).to_numpy()
+
+    df = df_src[df_src['Country'].isin(countries)]
+    index_dt = dates.get_indexer(df['Date'])
+    index_country = countries.get_indexer(df['Country'])
+
+    # Counts without a value are 0, as on the map before, but rates without one stay missing (NaN)
+    cube = np.zeros((len(dates), len(countries), len(cube_var)))
+    for i, var in enumerate(cube_var):
+        if is_rate(var):
+            cube[:, :, i] = np.nan
+            cube[index_dt, index_country, i] = df[var].to_numpy()
+        elif var.endswith('_Abs'):
+            cube[index_dt, index_country, i] = df[var].to_numpy()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rel = cube_var.index(var[:-4] + '_Rel')
+                cube[:, :, rel] = np.nan_to_num(100000*cube[:, :, i]/population, nan=0, posinf=0, neginf=0)
+            cube[:, :, i] = np.nan_to_num(cube[:, :, i], nan=0)
+
+    # Row of the cube for each (exploded) polygon of the map
+    return dates, cube, countries.get_indexer(df_geo['Country'])
+
+def get_extremes(cube):
+    # Color scale bounds of each variable (date x variable), with the bounds over all dates in
+    # the last row: the smallest and largest positive values ('min' and 'max') and the
+    # scale_quantiles of them ('low' and 'high'), picked by rank from the positive values.
+    # The signed rates are bounded by their size, on either side of 0, and missing values
+    # are left out.
+    signed = [i for i, var in enumerate(cube_var) if is_signed(var)]
+    cube = cube.copy()
+    cube[:, :, signed] = np.abs(cube[:, :, signed])
+    cube[np.isnan(cube)] = 0
+    quantiles = np.array([0] + scale_quantiles + [1])
+    values = np.sort(np.where(cube > 0, cube, np.nan).transpose(0, 2, 1), axis=2)
+    count = np.sum(cube > 0, axis=1)
+    ranks = np.maximum(np.floor(quantiles[:, None, None]*(count - 1)), 0).astype(int)
+    stats = np.take_along_axis(values[None], ranks[:, :, :, None], axis=3)[:, :, :, 0]
+
+    # Over all dates only the values at those ranks are needed, rather than sorting them all
+    overall = np.full((len(quantiles), 1, cube.shape[2]), np.nan)
+    for i in range(cube.shape[2]):
+        positive = cube[:, :, i][cube[:, :, i] > 0]
+        if len(positive):
+            ranks = np.floor(quantiles*(len(positive) - 1)).astype(int)
+            overall[:, 0, i] = np.partition(positive, ranks)[ranks]
+    stats = np.concatenate([stats, overall], axis=1)
+
+    # Dates without any positive value take the bounds over all dates, and data without any just 1
+    stats = np.nan_to_num(np.where(np.isnan(stats), overall, stats), nan=1)
+
+    return dict(zip(['min', 'low', 'high', 'max'], stats))
+
+def get_rows(df_src):
+    # Block of rows of each country, df_src being sorted by country and date, so that
+    # the time series of a selected country is a slice
+    countries, start, count = np.unique(df_src['Country'].to_numpy(), return_index=True, return_counts=True)
+
+    return {country : slice(start, start + count) for country, start, count in zip(countries, start, count)}
+
+def add_capita(df_src, population=None):
+    # Population and per 100k columns for the time series plots, computed once
+    # instead of for each selection (no population counts as 0, as on the map,
+    # and leaves the per 100k values missing)
+    if population is None:
+        population = df_countries.set_index('Country')['Population']
+    df = df_src.copy()
+    df['Population'] = df['Country'].map(population).fillna(0).astype(np.int64)
+    known = df['Population'].where(df['Population'] > 0)
+    for var in plot_var:
+        if var.endswith('_Rel'):
+            df[var] = df[var[:-4] + '_Abs'] if is_rate(var) else 100000*df[var[:-4] + '_Abs']/known
+
+    return df
+
+def get_totals(df_src):
+    # Totals of each date for the world and each region of Countries.csv, with their summed
+    # populations, in blocks of rows like the countries of df_src so that they can be plotted
+    # like one. A region that is both continental and statistical is only kept once. The rates
+    # are computed again from the summed counts.
+    columns = ['Population'] + [var for var in plot_var if var.endswith('_Abs') and not is_rate(var)]
+    regions = df_countries.set_index('Country')
+    groups = [pd.Series('World', index=df_src.index)]
+    groups += [df_src['Country'].map(regions[column]) for column in ['Continental Region', 'Statistical Region']]
+    df = pd.concat([df_src.groupby([group.rename('Country'), 'Date'])[columns].sum() for group in groups])
+    df = df[~df.index.duplicated()].reset_index().sort_values(['Country', 'Date'], kind='mergesort', ignore_index=True)
+    df = add_rates(df)
+    known = df['Population'].where(df['Population'] > 0)
+    for var in plot_var:
+        if var.endswith('_Rel'):
+            df[var] = df[var[:-4] + '_Abs'] if is_rate(var) else 100000*df[var[:-4] + '_Abs']/known
+
+    return df
+
+def get_compact(df_src):
+    # Smallest types for the shared data: categorical names, downcast integer counts,
+    # float32 averages and per 100k values
+    df = pd.DataFrame({'Date' : df_src['Date'], 'Country' : df_src['Country'].astype('category')})
+    for column in df_src.columns.drop(['Date', 'Country']):
+        values = df_src[column]
+        if values.dtype.kind in 'iu':
+            df[column] = pd.to_numeric(values, downcast='integer')
+        elif values.dtype.kind == 'f':
+            df[column] = values.astype(np.float32)
+        else:
+            df[column] = values
+
+    return df
+
+def get_memory(df):
+    return df.memory_usage(deep=True).sum() / 1024**2
+
+##################################################
+# Data shared by all sessions
+##################################################
+
+def get_data(source, resolution):
+    # Under bokeh serve the app script runs again for every session, but this module is
+    # only imported once, so each dataset is loaded once and then shared. The sessions
+    # must treat it as read-only and keep only their own selections and map values.
+    # This waits for the dataset, get_future does not.
+    return get_future(source, resolution).result()
+
+def get_future(source, resolution):
+    # Future of the latest snapshot of a dataset, already done unless it was never loaded,
+    # in which case it is loaded on the thread pool (once, however many sessions ask)
+    global refresh_thread
+
+    key = (source, resolution)
+    with datasets_lock:
+        if refresh_thread is None:
+            refresh_thread = threading.Thread(target=refresh, daemon=True)
+            refresh_thread.start()
+        if key in datasets:
+            future = Future()
+            future.set_result(datasets[key])
+            return future
+        if key not in loading:
+            loading[key] = load_pool.submit(load_key, key)
+
+        return loading[key]
+
+def get_snapshot(source, resolution):
+    # Latest snapshot of a dataset, None if not loaded yet
+    return datasets.get((source, resolution))
+
+def load_key(key):
+    try:
+        data = load_data(*key, get_inputs(key[0]))
+        with datasets_lock:
+            datasets[key] = data
+        return data
+    finally:
+        with datasets_lock:
+            loading.pop(key, None)
+
+def get_inputs(source):
+    # Files or URLs of the source, downloaded concurrently
+    return list(fetch_pool.map(fetch, sources[source]))
+
+def refresh():
+    # Reload the datasets whose inputs changed, the sessions keep their snapshot
+    # until they next ask for it
+    while True:
+        time.sleep(refresh_period)
+        for key, data in list(datasets.items()):
+            try:
+                inputs = get_inputs(key[0])
+                if all(new is old for new, old in zip(inputs, data['inputs'])):
+                    continue
+                data = load_data(*key, inputs)
+                with datasets_lock:
+                    datasets[key] = data
+                # The states are loaded again when next drilled into
+                if key[0] == 'JHU':
+                    with states_lock:
+                        states.clear()
+                log.info('%s %s data refreshed', *key)
+            except Exception:
+                log.exception('%s %s data not refreshed', *key)
+
+@timed
+def load_data(source, resolution, inputs):
+    df_src = get_src(source, resolution, inputs)
+    df_src = add_capita(add_rates(df_src))
+    df_totals = get_compact(get_totals(df_src))
+    memory = get_memory(df_src)
+    df_src = get_compact(df_src)
+    log.info('%s %s data: %.1f MB, %.1f MB with compact types', source, resolution, memory, get_memory(df_src))
+    df_geo, patches, outlines = get_geo(source, resolution)
+    dates, cube, index = get_cube(df_geo, df_src)
+    cube.flags.writeable = False
+
+    # Bounds of the countries with states, to read only their shapes
+    bounds = df_geo[df_geo['Country'].isin(state_countries)]
+    bounds = bounds.groupby('Country').agg({'minx' : 'min', 'miny' : 'min', 'maxx' : 'max', 'maxy' : 'max'})
+    df_geo = df_geo[['Country', 'Population']]
+
+    return {'src' : df_src, 'totals' : df_totals, 'total_rows' : get_rows(df_totals), 'geo' : df_geo, 'dates' : dates, 'cube' : cube, 'index' : index,
+            'extremes' : get_extremes(cube), 'outlines' : outlines, 'rows' : get_rows(df_src), 'patches' : patches, 'inputs' : inputs,
+            'bounds' : {country : tuple(values) for country, values in zip(bounds.index, bounds.to_numpy())}}
+
+##################################################
+# States of a country, loaded when drilled into
+##################################################
+
+def get_states(country, bounds):
+    # Future of the states of a country, already done if they are among the states_kept
+    # most recently used, otherwise loaded on the thread pool (once, however many sessions ask)
+    with states_lock:
+        if country in states:
+            states.move_to_end(country)
+            future = Future()
+            future.set_result(states[country])
+            return future
+        if country not in states_loading:
+            states_loading[country] = load_pool.submit(load_country, country, bounds)
+
+        return states_loading[country]
+
+def load_country(country, bounds):
+    try:
+        data = load_states(country, bounds)
+        with states_lock:
+            states[country] = data
+            while len(states) > states_kept:
+                states.popitem(last=False)
+        return data
+    finally:
+        with states_lock:
+            states_loading.pop(country, None)
+
+@timed
+def load_states(country, bounds):
+    # Time series, cube and outlines of the states, like load_data for the countries,
+    # except that the shapes are only at one resolution and not cached on disk
+    df_cases, df_deaths, population = pull_states(country)
+    df_src = get_compact(add_capita(add_rates(long_jhu(df_cases, df_deaths)), population))
+    df_geo = get_state_geo(country, bounds, population, df_cases.index)
+    dates, cube, index = get_cube(df_geo, df_src)
+    cube.flags.writeable = False
+
+    frames = {}
+    for level, tolerance in enumerate(geo_tolerance):
+        frames['xy' + str(level)], frames['n' + str(level)] = get_level(df_geo, tolerance)
+    df_geo = pd.DataFrame(df_geo[['Country', 'Population']])
+
+    return {'country' : country, 'src' : df_src, 'geo' : df_geo, 'dates' : dates, 'cube' : cube, 'index' : index,
+            'outlines' : split_outlines(frames), 'rows' : get_rows(df_src), 'patches' : get_patches(df_geo)}
+
+def pull_states(country):
+    # Wide (state x date) tables of the cases and deaths of the states, and their populations
+    # where JHU has them. Those of the US are summed from its (about 3000) counties, the others
+    # are the provinces of the global tables, which pull_jhu sums into their country.
+    aliases = get_aliases('JHU State')
+    if country == 'United States of America':
+        frames = [pd.read_csv(get_reader(data), encoding='utf-8') for data in get_inputs('JHU US')]
+        names = [get_names(df['Province_State'], aliases) for df in frames]
+    else:
+        frames = [pd.read_csv(get_reader(data), encoding='utf-8') for data in get_inputs('JHU')]
+        frames = [df[get_names(df['Country/Region'], get_aliases('JHU')) == country] for df in frames]
+        names = [get_names(df['Province/State'], aliases) for df in frames]
+
+    tables = []
+    for df, name in zip(frames, names):
+        dates = df.columns[df.columns.str.match(r'\d+/\d+/\d+$')]
+        df = df[dates].groupby(name.rename('Country')).sum()
+        df.columns = pd.to_datetime(dates, format='%m/%d/%y')
+        tables.append(df)
+    df_cases, df_deaths = tables
+    df_deaths = df_deaths.reindex(index=df_cases.index, columns=df_cases.columns, fill_value=0)
+
+    if 'Population' in frames[1]:
+        population = frames[1]['Population'].groupby(names[1]).sum()
+    else:
+        population = pd.Series(dtype=np.int64)
+
+    return df_cases, df_deaths, population
+
+def get_state_geo(country, bounds, population, names):
+    # Shapes of the states, only reading those of the shapefile within the country's bounds,
+    # named by their English name where only that matches the names of the time series
+    import geopandas as gpd
+
+    df = gpd.read_file(states_file, bbox=bounds)
+    df = df[df['admin'] == country].copy()
+    df['Country'] = df['name']
+    if 'name_en' in df:
+        df['Country'] = df['name'].where(df['name'].isin(names) | ~df['name_en'].isin(names), df['name_en'])
+    missing = sorted(set(names) - set(df['Country']))
+    if missing:
+        log.warning('%s states without shapes: %s', country, ', '.join(missing))
+    df = df[['Country', 'geometry']]
+    df['Population'] = df['Country'].map(population)
+
+    df = df.explode()
+    df.reset_index(inplace = True)
+
+    return df
+
+##################################################
+# Tables to match country names and populations
+##################################################
+
+df_sub = pd.read_csv('Subunits_and_small_shapes.csv', encoding='utf-8', error_bad_lines=False)
+df_alias = pd.read_csv('Aliases.csv', encoding='utf-8', keep_default_na=False)
+df_countries = pd.read_csv('Countries.csv', encoding='utf-8')
@@ -0,0 +1,141 @@
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from bokeh.document.events import ColumnDataChangedEvent, ColumnsPatchedEvent, ColumnsStreamedEvent, ModelChangedEvent
+import bisect
+import logging
+import numpy as np
+import os
+import threading
+import time
+
+# Timings of the loaders and callbacks, and sizes of the data sent to the browser, kept as
+# histograms and served in the Prometheus text format. Like covid_data this module is only
+# imported once per server process, so the histograms add up over all the sessions.
+#
+# Off unless a port is given, e.g. COVID_METRICS_PORT=9100 bokeh serve COVID-19.py, and then
+# read at http://127.0.0.1:9100/metrics. When off, timed leaves the functions as they are
+# and watch adds nothing to the document, so there is no overhead at all.
+metrics_port = int(os.environ.get('COVID_METRICS_PORT', '0'))
+enabled = metrics_port > 0
+
+# Upper bounds of the histogram buckets, in seconds and in bytes
+metrics = {'seconds' : ('Time taken by the data loaders and the session callbacks',
+                        [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]),
+           'bytes' : ('Approximate size of the column data sent to the browser, by data source',
+                      [1e3, 1e4, 1e5, 1e6, 1e7, 1e8])}
+
+log = logging.getLogger(__name__)
+
+# Count in each bucket (the last one past all the bounds), sum and count of each metric and name
+histograms = {metric : {} for metric in metrics}
+histograms_lock = threading.Lock()
+server = None
+
+##################################################
+# Functions to record the metrics
+##################################################
+
+def observe(metric, name, value):
+    bounds = metrics[metric][1]
+    index = bisect.bisect_left(bounds, value)
+    with histograms_lock:
+        counts = histograms[metric].setdefault(name, [[0]*(len(bounds) + 1), 0.0, 0])
+        counts[0][index] += 1
+        counts[1] += value
+        counts[2] += 1
+
+def timed(func):
+    # Time each call of the function into the histogram of its name, keeping its signature
+    # so that Bokeh still accepts it as a callback
+    if not enabled:
+        return func
+
+    @wraps(func)
+    def call(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            observe('seconds', func.__name__, time.perf_counter() - start)
+    return call
+
+def get_size(value):
+    # Bytes of a column, arrays by their buffers and lists (of arrays for the outlines) by their
+    # items, taking 8 bytes for anything else
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(get_size(item) for item in value) if value and isinstance(value[0], np.ndarray) else 8*len(value)
+    return 8
+
+def watch(doc, sources):
+    # Add the size of every change of the named data sources of a session to the histograms
+    if not enabled:
+        return
+    names = {source.id : name for name, source in sources.items()}
+
+    def count(event):
+        # Whole data set, some of its columns (data.update), or rows streamed or patched into it
+        if isinstance(event, ModelChangedEvent) and event.attr == 'data':
+            source = event.model
+            size = sum(get_size(values) for values in source.data.values())
+        elif isinstance(event, ColumnDataChangedEvent):
+            source = event.column_source
+            size = sum(get_size(source.data[column]) for column in (event.cols or source.data))
+        elif isinstance(event, ColumnsStreamedEvent):
+            source = event.column_source
+            size = sum(get_size(values) for values in event.data.values())
+        elif isinstance(event, ColumnsPatchedEvent):
+            source = event.column_source
+            size = sum(16*len(patches) for patches in event.patches.values())
+        else:
+            return
+        if source.id in names:
+            observe('bytes', names[source.id], size)
+
+    doc.on_change(count)
+
+##################################################
+# Endpoint serving the metrics
+##################################################
+
+def get_text():
+    # All the histograms in the Prometheus text format, with cumulative buckets
+    lines = []
+    with histograms_lock:
+        for metric, (description, bounds) in metrics.items():
+            lines += ['# HELP covid_' + metric + ' ' + description, '# TYPE covid_' + metric + ' histogram']
+            for name, (counts, total, count) in sorted(histograms[metric].items()):
+                for bound, cumulative in zip(bounds + ['+Inf'], np.cumsum(counts)):
+                    lines.append('covid_{}_bucket{{name="{}",le="{}"}} {}'.format(metric, name, bound, cumulative))
+                lines.append('covid_{}_sum{{name="{}"}} {}'.format(metric, name, total))
+                lines.append('covid_{}_count{{name="{}"}} {}'.format(metric, name, count))
+
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = get_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_server(port=metrics_port):
+    # Serve the metrics on the local host from a thread of its own, once per process
+    global server
+    if server is None:
+        server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        log.info('Metrics served at http://127.0.0.1:%d/metrics', server.server_port)
+    return server
+
+if enabled:
+    start_server()
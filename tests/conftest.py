@@ -0,0 +1,7 @@
+import os
+import sys
+
+# covid_data reads its name tables from the working directory when imported
+app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, app_dir)
+os.chdir(app_dir)
@@ -0,0 +1,231 @@
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import covid_data
+
+##################################################
+# Small inputs, in the layout of the WHO and JHU files
+##################################################
+
+def make_jhu(scale):
+    # Cumulative counts of a few countries, Canada split into provinces and Burma renamed by Aliases.csv
+    rows = [(np.nan, 'France'), (np.nan, 'Burma'), ('Ontario', 'Canada'), ('Quebec', 'Canada'), (np.nan, 'Peru')]
+    dates = pd.date_range('2020-01-22', periods=20)
+    rng = np.random.default_rng(scale)
+    df = pd.DataFrame(rng.poisson(scale, (len(rows), len(dates))).cumsum(axis=1),
+                      columns=['{}/{}/{}'.format(dt.month, dt.day, dt.strftime('%y')) for dt in dates])
+    df.insert(0, 'Province/State', [province for province, country in rows])
+    df.insert(1, 'Country/Region', [country for province, country in rows])
+    df.insert(2, 'Lat', 0.0)
+    df.insert(3, 'Long', 0.0)
+    return df.to_csv(index=False)
+
+def make_who():
+    # Daily counts of a few countries, a few days each
+    rows = []
+    for country, code in [('France', 'FR'), ('Peru', 'PE'), ('Viet Nam', 'VN')]:
+        cases = deaths = 0
+        for day, dt in enumerate(pd.date_range('2020-03-01', periods=5)):
+            cases += day
+            deaths += day // 2
+            rows.append((dt.strftime('%Y-%m-%d'), code, country, 'EURO', day, cases, day // 2, deaths))
+    return pd.DataFrame(rows, columns=['Date_reported', 'Country_code', 'Country', 'WHO_region', 'New_cases',
+                                       'Cumulative_cases', 'New_deaths', 'Cumulative_deaths'])
+
+##################################################
+# JHU
+##################################################
+
+def rolling_mean(df, column):
+    # Mean over 7 days of each country by row of df, newer pandas also put the country in the index
+    mean = df.groupby('Country', group_keys=False).rolling('7D', on='Date').mean()[column]
+    return mean.droplevel(0) if mean.index.nlevels > 1 else mean
+
+def loop_jhu(cases, deaths):
+    # The JHU data as it was built with a loop over the days
+    df_cases_tot = covid_data.pull_jhu(cases, '110m')
+    df_deaths_tot = covid_data.pull_jhu(deaths, '110m')
+
+    first_dt = df_cases_tot.columns[1]
+    last_dt = df_cases_tot.columns[-1]
+    df_cases_new = df_cases_tot.copy()
+    df_deaths_new = df_deaths_tot.copy()
+    new_dt = last_dt
+    while new_dt > first_dt:
+        df_cases_new[new_dt] = (df_cases_new[new_dt] - df_cases_new[(new_dt - timedelta(1))])
+        df_deaths_new[new_dt] = (df_deaths_new[new_dt] - df_deaths_new[(new_dt - timedelta(1))])
+        new_dt = (new_dt - timedelta(1))
+    df_cases_new[first_dt] = 0
+    df_deaths_new[first_dt] = 0
+
+    df_cases_tot = df_cases_tot.melt(id_vars=['Country'], var_name='Date', value_name='Cases_Tot_Abs')
+    df_cases_new = df_cases_new.melt(id_vars=['Country'], var_name='Date', value_name='Cases_New_Abs')
+    df_deaths_tot = df_deaths_tot.melt(id_vars=['Country'], var_name='Date', value_name='Deaths_Tot_Abs')
+    df_deaths_new = df_deaths_new.melt(id_vars=['Country'], var_name='Date', value_name='Deaths_New_Abs')
+
+    df = df_cases_tot[['Date', 'Country', 'Cases_Tot_Abs']].copy()
+    df['Cases_New_Abs'] = df_cases_new['Cases_New_Abs']
+    df['Cases_Avg_Abs'] = rolling_mean(df, 'Cases_New_Abs')
+    df['Deaths_Tot_Abs'] = df_deaths_tot['Deaths_Tot_Abs']
+    df['Deaths_New_Abs'] = df_deaths_new['Deaths_New_Abs']
+    df['Deaths_Avg_Abs'] = rolling_mean(df, 'Deaths_New_Abs')
+    df = df.sort_values(['Country', 'Date'])
+    df.reset_index(inplace = True)
+    return df
+
+def test_get_jhu_matches_loop():
+    cases, deaths = make_jhu(50), make_jhu(2)
+    df = covid_data.get_jhu('110m', io.StringIO(cases), io.StringIO(deaths))
+    df_loop = loop_jhu(io.StringIO(cases), io.StringIO(deaths))
+
+    assert sorted(df['Country'].unique()) == ['Canada', 'France', 'Myanmar', 'Peru']
+    pd.testing.assert_frame_equal(df[df_loop.columns], df_loop, check_exact=True)
+
+def get_src(population=None):
+    # The JHU data with its rates and per 100k values, as load_data has it
+    df = covid_data.get_jhu('110m', io.StringIO(make_jhu(50)), io.StringIO(make_jhu(2)))
+    return covid_data.add_capita(covid_data.add_rates(df), population)
+
+##################################################
+# Rates, totals and color scales
+##################################################
+
+def test_add_rates_matches_shifts():
+    df = get_src()
+    for country in df['Country'].unique():
+        df_country = df[df['Country'] == country].set_index('Date').asfreq('D')
+        avg = df_country['Cases_Avg_Abs'].astype(float)
+        week = (avg / avg.shift(covid_data.rate_days)).replace([np.inf, -np.inf], np.nan)
+        expected = pd.DataFrame({'Growth' : 100*(week**(1 / covid_data.rate_days) - 1), 'WoW' : 100*(week - 1),
+                                 'Rt' : (avg / avg.shift(covid_data.serial_days)).replace([np.inf, -np.inf, 0], np.nan),
+                                 'CFR' : (100*df_country['Deaths_Tot_Abs'].astype(float) / df_country['Cases_Tot_Abs']).replace([np.inf, -np.inf], np.nan)})
+        for stat in expected:
+            found = df_country['Cases_' + stat + '_Abs'].to_numpy(float)
+            assert np.allclose(found, expected[stat].to_numpy(float), rtol=1e-4, equal_nan=True), (country, stat)
+
+def test_add_capita_without_population():
+    df = get_src(pd.Series({'France' : 200000}))
+
+    # Per 100k values are missing rather than infinite without a population, the rates are kept
+    france = df['Country'] == 'France'
+    assert np.allclose(df.loc[france, 'Cases_Tot_Rel'], df.loc[france, 'Cases_Tot_Abs'] / 2)
+    assert df.loc[~france, 'Cases_Tot_Rel'].isna().all() and (df.loc[~france, 'Population'] == 0).all()
+    assert df['Cases_CFR_Rel'].equals(df['Cases_CFR_Abs'])
+
+def test_get_totals_sums_countries():
+    df_src = get_src()
+    df = covid_data.get_totals(df_src)
+    rows = covid_data.get_rows(df)
+    europe = df_src['Country'].isin(covid_data.df_countries.loc[covid_data.df_countries['Continental Region'] == 'Europe', 'Country'])
+    for name, df_region in [('World', df_src), ('Europe', df_src[europe])]:
+        expected = df_region.groupby('Date')[['Population', 'Cases_Tot_Abs', 'Deaths_Avg_Abs']].sum()
+        found = df.iloc[rows[name]].set_index('Date')[expected.columns]
+        assert np.allclose(found.to_numpy(float), expected.to_numpy(float), rtol=1e-5)
+
+def test_get_extremes_matches_quantiles():
+    # A cube of a few dates, countries and all the variables, the signed rates falling as well as rising
+    rng = np.random.default_rng(4)
+    cube = rng.exponential(100, (10, 30, len(covid_data.cube_var)))
+    for var, name in enumerate(covid_data.cube_var):
+        if covid_data.is_signed(name):
+            cube[:, :, var] -= 100
+    cube[rng.random(cube.shape) < 0.2] = np.nan
+
+    extremes = covid_data.get_extremes(cube)
+    for index_dt in [0, 5, 9, None]:
+        values = cube if index_dt is None else cube[index_dt:index_dt + 1]
+        for var, name in enumerate(covid_data.cube_var):
+            # The signed rates are bounded by their size
+            column = np.abs(values[:, :, var]) if covid_data.is_signed(name) else values[:, :, var]
+            positive = column[column > 0]
+            expected = np.quantile(positive, [0] + covid_data.scale_quantiles + [1], interpolation='lower')
+            found = [extremes[bound][-1 if index_dt is None else index_dt, var] for bound in ['min', 'low', 'high', 'max']]
+            assert np.allclose(found, expected), (index_dt, name)
+
+##################################################
+# WHO
+##################################################
+
+def read_who(df):
+    return covid_data.read_who(io.StringIO(df.to_csv(index=False)), covid_data.get_aliases('WHO', '110m'))
+
+def test_read_who_finds_columns_by_header():
+    df = make_who()
+    expected = read_who(df)
+
+    assert read_who(df[df.columns[::-1]]).equals(expected)
+    assert sorted(expected['Country'].unique()) == ['France', 'Peru', 'Vietnam']
+    assert expected.loc[expected['Country'] == 'Peru', 'Cases_Tot_Abs'].tolist() == [0, 1, 3, 6, 10]
+
+def test_read_who_fails_on_renamed_column():
+    with pytest.raises(ValueError):
+        read_who(make_who().rename(columns={'New_cases' : 'Cases'}))
+
+##################################################
+# Fetching the inputs
+##################################################
+
+class StandIn(BaseHTTPRequestHandler):
+    # Stand-in for the JHU files on GitHub, answering conditional requests with an ETag
+    files = {}
+    answers = []
+
+    def do_GET(self):
+        content = self.files[self.path]
+        etag = '"{:x}"'.format(hash(content))
+        if self.headers.get('If-None-Match') == etag:
+            self.answers.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.answers.append(200)
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def stand_in():
+    StandIn.files = {'/cases.csv' : make_jhu(50).encode()}
+    StandIn.answers = []
+    server = HTTPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}/cases.csv'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+def test_fetch_url_conditional(stand_in):
+    data = covid_data.fetch(stand_in)
+    assert covid_data.get_reader(data).read() == StandIn.files['/cases.csv']
+
+    # Unchanged, the server answers 304 and the same input is kept, so nothing is reloaded
+    assert covid_data.fetch(stand_in) is data
+    StandIn.files['/cases.csv'] = make_jhu(60).encode()
+    changed = covid_data.fetch(stand_in)
+    assert changed is not data and changed[0] != data[0]
+    assert StandIn.answers == [200, 304, 200]
+
+def test_fetch_file_keeps_path(tmp_path):
+    file = tmp_path / 'who.csv'
+    file.write_text(make_who().to_csv(index=False))
+    data = covid_data.fetch(str(file))
+
+    # Only the digest and the path are kept, read from again by pandas
+    assert data[1] == str(file)
+    assert covid_data.fetch(str(file)) is data
+    assert covid_data.read_who(covid_data.get_reader(data), covid_data.get_aliases('WHO', '110m')).equals(read_who(make_who()))
+
+    file.write_text(make_who().iloc[:-1].to_csv(index=False))
+    os.utime(file, (0, 0))
+    assert covid_data.fetch(str(file))[0] != data[0]